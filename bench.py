@@ -0,0 +1,152 @@
+#!/usr/bin/env python3
+"""
+Benchmarks for insta.py that run without an Instagram login.
+
+  python bench.py startup [--budget SECONDS] [--runs N]
+      Time `python insta.py help` in fresh processes and fail if the median
+      exceeds the budget or if instagrapi got imported on that path.
+
+  python bench.py parse [--messages N]
+      Parse throughput of the DM command dispatcher over a corpus of realistic
+      inbox texts (mostly chatter, some commands), compared with the previous
+      uncompiled regex cascade.
+"""
+
+import random
+import re
+import statistics
+import subprocess
+import sys
+import time
+from pathlib import Path
+
+HERE = Path(__file__).resolve().parent
+STARTUP_BUDGET_SECONDS = 1.0
+
+def _option(args, name, default, cast):
+    if name in args:
+        return cast(args[args.index(name) + 1])
+    return default
+
+def bench_startup(args):
+    budget = _option(args, "--budget", STARTUP_BUDGET_SECONDS, float)
+    runs = _option(args, "--runs", 5, int)
+    timings = []
+    for _ in range(runs):
+        started = time.perf_counter()
+        result = subprocess.run(
+            [sys.executable, str(HERE / "insta.py"), "help"],
+            cwd=HERE,
+            stdin=subprocess.DEVNULL,
+            capture_output=True,
+            timeout=60,
+        )
+        timings.append(time.perf_counter() - started)
+        if result.returncode != 0:
+            print(f"✗ `insta.py help` exited with {result.returncode}")
+            print(result.stderr.decode(errors="replace"))
+            return 1
+    median = statistics.median(timings)
+    print(f"insta.py help: median {median * 1000:.0f} ms, min {min(timings) * 1000:.0f} ms over {runs} runs (budget {budget * 1000:.0f} ms)")
+
+    probe = subprocess.run(
+        [sys.executable, "-c", "import sys, insta; print('instagrapi' in sys.modules)"],
+        cwd=HERE,
+        stdin=subprocess.DEVNULL,
+        capture_output=True,
+        timeout=60,
+    )
+    if probe.stdout.decode().strip() != "False":
+        print("✗ importing insta.py pulled in instagrapi (or failed)")
+        print(probe.stderr.decode(errors="replace"))
+        return 1
+    if median > budget:
+        print("✗ startup is over budget")
+        return 1
+    print("✓ startup within budget")
+    return 0
+
+CHATTER = [
+    "hey! how are you?",
+    "lol that reel was hilarious 😂",
+    "are we still on for tomorrow",
+    "ok",
+    "Thanks!!",
+    "did you see the post from @travelgram? we should go there",
+    "can you send me the link to that video",
+    "haha yes",
+    "I'll follow up with you later about the photos",
+    "👍",
+    "where are you now? text me when you're back",
+    "let me know if you want to download the pics from the trip",
+]
+COMMAND_TEXTS = [
+    "follow @someuser",
+    "unfollow @someuser",
+    "like the latest reel of @seedhamaut",
+    "like the latest post of @seedhamaut",
+    "write hello there to @vansh",
+    "download stories of @someuser",
+    "download latest reel of @someuser",
+    "download latest post of @someuser",
+    "status of @someuser",
+    "show dms 10",
+]
+
+# The cascade try_parse_and_execute_commands ran before the command registry
+LEGACY_PATTERNS = [
+    r"like\s+(?:the\s+)?latest\s+reel\s+of\s+@([A-Za-z0-9._]+)",
+    r"like\s+(?:the\s+)?latest\s+post\s+of\s+@([A-Za-z0-9._]+)",
+    r"^follow\s+@([A-Za-z0-9._]+)$",
+    r"^unfollow\s+@([A-Za-z0-9._]+)$",
+    r"(?:write|send)\s+(.+?)\s+to\s+@([A-Za-z0-9._]+)$",
+    r"download\s+(?:story|stories)\s+of\s+@([A-Za-z0-9._]+)$",
+    r"download\s+(?:latest\s+)?reel\s+of\s+@([A-Za-z0-9._]+)$",
+    r"download\s+(?:latest\s+)?post\s+of\s+@([A-Za-z0-9._]+)$",
+    r"status\s+of\s+@([A-Za-z0-9._]+)$",
+    r"^show\s+dms?(?:\s+(\d+))?$",
+    r"like\s+posts\s+from\s+hashtag\s+(\w+)\s+(\d+)?",
+    r"follow\s+from\s+hashtag\s+(\w+)\s+(\d+)?",
+    r"like\s+posts\s+from\s+location\s+(\w+)\s+(\d+)?",
+    r"download\s+profile\s+picture\s+of\s+@([A-Za-z0-9._]+)$",
+]
+LEGACY_LITERALS = ("show live dms", "hide live dms", "resolve usernames on", "resolve usernames off")
+
+def _legacy_match(text):
+    t = text.strip()
+    for i, pattern in enumerate(LEGACY_PATTERNS):
+        if re.search(pattern, t, flags=re.IGNORECASE):
+            return i
+    return t.lower() if t.lower() in LEGACY_LITERALS else None
+
+def _throughput(func, corpus):
+    started = time.perf_counter()
+    hits = sum(1 for text in corpus if func(text) is not None)
+    return len(corpus) / (time.perf_counter() - started), hits
+
+def bench_parse(args):
+    sys.path.insert(0, str(HERE))
+    import insta
+
+    messages = _option(args, "--messages", 200_000, int)
+    rng = random.Random(42)
+    # ~95% of inbox traffic is ordinary conversation
+    corpus = [rng.choice(COMMAND_TEXTS) if rng.random() < 0.05 else rng.choice(CHATTER) for _ in range(messages)]
+    registry_rate, registry_hits = _throughput(insta.command_registry.match, corpus)
+    legacy_rate, legacy_hits = _throughput(_legacy_match, corpus)
+    print(f"{messages} messages ({sum(t in COMMAND_TEXTS for t in corpus)} commands)")
+    print(f"  command registry: {registry_rate:,.0f} msg/s ({registry_hits} matched)")
+    print(f"  legacy cascade:   {legacy_rate:,.0f} msg/s ({legacy_hits} matched)")
+    print(f"  speedup: {registry_rate / legacy_rate:.1f}x")
+    return 0
+
+BENCHMARKS = {
+    "startup": bench_startup,
+    "parse": bench_parse,
+}
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2 or sys.argv[1] not in BENCHMARKS:
+        print(__doc__)
+        sys.exit(1)
+    sys.exit(BENCHMARKS[sys.argv[1]](sys.argv[2:]))
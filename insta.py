@@ -1,13 +1,27 @@
+import asyncio
 import time
-from instagrapi import Client
-from instagrapi.exceptions import ClientConnectionError
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import re
 import threading
 import os
 from pathlib import Path
+import hashlib
+import heapq
 import json
 import sys
+import ipaddress
+import random
+import signal
+import multiprocessing
+import shutil
+import sqlite3
+import subprocess
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from urllib.parse import urlparse
 try:
     from dotenv import load_dotenv  # optional
     load_dotenv()
@@ -17,6 +31,30 @@ from getpass import getpass
 
 SECRETS_PATH = "secrets.json"
 
+class _InstagrapiNotLoaded(Exception):
+    """Stand-in for instagrapi names until _import_instagrapi() runs; never raised."""
+
+# instagrapi is slow to import, so it is loaded only by subcommands that log in
+Client = None
+ClientConnectionError = ClientThrottledError = PleaseWaitFewMinutes = RateLimitError = UserNotFound = _InstagrapiNotLoaded
+LoginRequired = ClientLoginRequired = ClientUnauthorizedError = FeedbackRequired = _InstagrapiNotLoaded
+
+def _import_instagrapi():
+    global Client, ClientConnectionError, ClientThrottledError, PleaseWaitFewMinutes, RateLimitError, UserNotFound
+    global LoginRequired, ClientLoginRequired, ClientUnauthorizedError, FeedbackRequired
+    from instagrapi import Client
+    from instagrapi.exceptions import (
+        ClientConnectionError,
+        ClientLoginRequired,
+        ClientThrottledError,
+        ClientUnauthorizedError,
+        FeedbackRequired,
+        LoginRequired,
+        PleaseWaitFewMinutes,
+        RateLimitError,
+        UserNotFound,
+    )
+
 def load_secrets(path=SECRETS_PATH):
     try:
         with open(path, "r", encoding="utf-8") as f:
@@ -46,23 +84,120 @@ def write_secrets(secrets, path=SECRETS_PATH):
     except Exception as e:
         print(f"Warning: failed to persist secrets: {e}")
 
-def get_public_ip():
+# Process-wide keep-alive session for all non-instagrapi HTTP traffic
+HTTP_TIMEOUT = (5, 15)  # (connect, read) seconds
+HTTP_POOL_HOSTS = 16  # host pools kept alive
+HTTP_POOL_PER_HOST = 8  # connections per host
+_http_session = None
+_http_session_lock = threading.Lock()
+
+def http_session():
+    global _http_session
+    with _http_session_lock:
+        if _http_session is None:
+            retry = Retry(
+                total=3,
+                connect=3,
+                read=2,
+                backoff_factor=0.5,
+                status_forcelist=(500, 502, 503, 504),
+                allowed_methods=("GET", "HEAD"),
+            )
+            adapter = HTTPAdapter(pool_connections=HTTP_POOL_HOSTS, pool_maxsize=HTTP_POOL_PER_HOST, max_retries=retry)
+            session = requests.Session()
+            session.mount("https://", adapter)
+            session.mount("http://", adapter)
+            _http_session = session
+        return _http_session
+
+def http_get(url, **kwargs):
+    """GET through the shared session, with default timeouts."""
+    kwargs.setdefault("timeout", HTTP_TIMEOUT)
+    return http_session().get(url, **kwargs)
+
+def http_pool_stats():
+    """Per-host request/connection counters; reused = requests served without a new connection."""
+    stats = {}
+    if _http_session is None:
+        return stats
+    seen = set()
+    for adapter in _http_session.adapters.values():
+        if id(adapter) in seen:
+            continue
+        seen.add(id(adapter))
+        pools = adapter.poolmanager.pools
+        for key in list(pools.keys()):
+            pool = pools.get(key)
+            if pool is None:
+                continue
+            requests_made = getattr(pool, "num_requests", 0)
+            connections = getattr(pool, "num_connections", 0)
+            stats[pool.host] = {
+                "requests": requests_made,
+                "connections": connections,
+                "reused": max(0, requests_made - connections),
+            }
+    return stats
+
+PUBLIC_IP_PROVIDERS = (
+    "https://api.ipify.org",
+    "https://ifconfig.me/ip",
+    "https://ipv4.icanhazip.com",
+)
+PUBLIC_IP_CACHE_PATH = ".public_ip_cache.json"
+PUBLIC_IP_CACHE_TTL = 600  # seconds
+_public_ip = None
+_public_ip_lock = threading.Lock()
+
+def _query_ip_provider(url):
+    r = http_get(url, timeout=5)
+    r.raise_for_status()
+    # Decode explicitly; charset guessing can mangle a bare "1.2.3.4\n" body
+    ip = r.content.decode("ascii", "ignore").strip()
+    ipaddress.ip_address(ip)  # reject captive-portal pages and other junk
+    return ip
+
+def _detect_public_ip():
+    """Race all providers and return (ip, source) from the first valid answer."""
+    pool = ThreadPoolExecutor(max_workers=len(PUBLIC_IP_PROVIDERS), thread_name_prefix="ip-probe")
+    futures = {pool.submit(_query_ip_provider, url): url for url in PUBLIC_IP_PROVIDERS}
     try:
-        # Try multiple providers for resilience
-        for url in (
-            "https://api.ipify.org",
-            "https://ifconfig.me/ip",
-            "https://ipv4.icanhazip.com",
-        ):
+        for future in as_completed(futures):
             try:
-                r = requests.get(url, timeout=5)
-                if r.ok:
-                    return r.text.strip()
+                return future.result(), futures[future]
             except Exception:
                 continue
-    except Exception:
-        pass
-    return None
+    finally:
+        pool.shutdown(wait=False, cancel_futures=True)
+    return None, None
+
+def get_public_ip():
+    """Public IP of this machine, detected once per process and cached on disk for a short TTL."""
+    global _public_ip
+    with _public_ip_lock:
+        if _public_ip:
+            return _public_ip
+        started = time.time()
+        try:
+            with open(PUBLIC_IP_CACHE_PATH, "r", encoding="utf-8") as f:
+                cached = json.load(f)
+            if time.time() - float(cached.get("detected_at", 0)) < PUBLIC_IP_CACHE_TTL:
+                _public_ip = str(ipaddress.ip_address(cached["ip"]))
+                print(f"Public IP {_public_ip} (cached, {(time.time() - started) * 1000:.0f} ms)")
+                return _public_ip
+        except Exception:
+            pass
+        ip, source = _detect_public_ip()
+        if not ip:
+            return None
+        _public_ip = ip
+        print(f"Public IP {ip} detected via {urlparse(source).netloc} in {(time.time() - started) * 1000:.0f} ms")
+        try:
+            with open(PUBLIC_IP_CACHE_PATH, "w", encoding="utf-8") as f:
+                json.dump({"ip": ip, "detected_at": time.time()}, f)
+        except Exception as e:
+            print(f"Warning: failed to cache public IP: {e}")
+        return _public_ip
 
 def require_allowed_ip(secrets):
     ip = get_public_ip()
@@ -85,15 +220,8 @@ def require_allowed_ip(secrets):
         return True
     return True
 
-# Login (secured via secrets.json, optional .env, or environment variables)
-secrets = load_secrets()
-require_allowed_ip(secrets)
-current_ip = get_public_ip()
-username_env = os.environ.get("IG_USERNAME")
-password_env = os.environ.get("IG_PASSWORD")
-
-# If ENV creds are missing, interactively prompt and persist to .env
-if not username_env or not password_env:
+def prompt_for_credentials():
+    """Ask for IG_USERNAME/IG_PASSWORD on the terminal and persist them to .env."""
     print("Instagram credentials not found in environment. Please enter them now.")
     entered_user = input("IG_USERNAME: ").strip()
     entered_pass = getpass("IG_PASSWORD: ")
@@ -116,74 +244,191 @@ if not username_env or not password_env:
             load_dotenv(override=True)
         except Exception:
             pass
-        username_env = entered_user
-        password_env = entered_pass
         print("Saved credentials to .env")
     except Exception as e:
         print(f"Warning: failed to write .env ({e}). Proceeding without saving.")
-        username_env = entered_user
-        password_env = entered_pass
-
-# Resolve credentials precedence:
-# 1) Environment (.env or OS env)
-# 2) Per-IP credentials in secrets
-# 3) Global credentials in secrets
-creds_by_ip = secrets.get("credentials_by_ip", {}) or {}
-ip_creds = creds_by_ip.get(current_ip or "", {}) if current_ip else {}
-username = username_env or ip_creds.get("username") or secrets.get("username")
-password = password_env or ip_creds.get("password") or secrets.get("password")
-
-if username_env and password_env and current_ip:
-    # Remember env credentials for this IP so future runs work without env
-    if current_ip not in creds_by_ip:
-        creds_by_ip[current_ip] = {"username": username_env, "password": password_env}
-        secrets["credentials_by_ip"] = creds_by_ip
-        write_secrets(secrets)
+    return entered_user, entered_pass
 
-if not username or not password:
-    print("Missing credentials. Provide .env (IG_USERNAME/IG_PASSWORD) or secrets.json.")
-    raise SystemExit(1)
+def resolve_credentials(secrets, current_ip):
+    username_env = os.environ.get("IG_USERNAME")
+    password_env = os.environ.get("IG_PASSWORD")
 
-cl = Client()
+    # If ENV creds are missing, interactively prompt and persist to .env
+    if not username_env or not password_env:
+        username_env, password_env = prompt_for_credentials()
 
-# Handle session persistence and 2FA if required
-session_file = f"session_{username}.json"
+    # Resolve credentials precedence:
+    # 1) Environment (.env or OS env)
+    # 2) Per-IP credentials in secrets
+    # 3) Global credentials in secrets
+    creds_by_ip = secrets.get("credentials_by_ip", {}) or {}
+    ip_creds = creds_by_ip.get(current_ip or "", {}) if current_ip else {}
+    username = username_env or ip_creds.get("username") or secrets.get("username")
+    password = password_env or ip_creds.get("password") or secrets.get("password")
 
-# Try to load existing session first
-if os.path.exists(session_file):
-    try:
-        cl.load_settings(session_file)
-        cl.login(username, password)
-        print("Logged in using saved session")
-    except Exception as e:
-        print(f"Could not login with saved session: {e}")
-        # Need to login fresh and save session
-        cl = Client()
-else:
-    cl = Client()
-
-# If not logged in with session, perform fresh login
-if not cl.user_id:
-    try:
-        cl.login(username, password)
-        # Save session for future use
-        cl.dump_settings(session_file)
-        print("New session saved")
-    except Exception as e:
-        if "Two-factor authentication required" in str(e):
-            print("Two-factor authentication is required.")
-            verification_code = input("Please enter your 2FA verification code: ")
-            try:
-                cl.login(username, password, verification_code=verification_code)
-                # Save session for future use
-                cl.dump_settings(session_file)
-                print("New session saved")
-            except Exception as e2:
-                print(f"Login failed: {e2}")
+    if username_env and password_env and current_ip:
+        # Remember env credentials for this IP so future runs work without env
+        if current_ip not in creds_by_ip:
+            creds_by_ip[current_ip] = {"username": username_env, "password": password_env}
+            secrets["credentials_by_ip"] = creds_by_ip
+            write_secrets(secrets)
+
+    if not username or not password:
+        print("Missing credentials. Provide .env (IG_USERNAME/IG_PASSWORD) or secrets.json.")
+        raise SystemExit(1)
+    return username, password
+
+class SessionManager:
+    """Reuse session_<username>.json when it is still valid, log in only when it is not.
+
+    A saved session is checked with a single authenticated call (account_info);
+    a full login happens only on a real auth failure, and the settings file is
+    rewritten only when the auth state actually changed.
+    """
+
+    # Settings keys that change when Instagram rotates the session
+    AUTH_KEYS = ("authorization_data", "cookies", "mid", "ig_u_rur", "ig_www_claim")
+
+    def __init__(self, username, password, session_file=None):
+        self.username = username
+        self.password = password
+        self.session_file = session_file or f"session_{username}.json"
+        self.stats = {}
+
+    def _auth_state(self, client):
+        settings = client.get_settings()
+        # Deep copy: some of these are live dicts the client mutates in place
+        return json.loads(json.dumps({key: settings.get(key) for key in self.AUTH_KEYS}, default=str))
+
+    def _session_age_seconds(self, settings):
+        last_login = settings.get("last_login")
+        if not last_login:
+            last_login = os.path.getmtime(self.session_file)
+        return max(0.0, time.time() - float(last_login))
+
+    def _restore(self):
+        """Return (client, auth state as loaded) for the saved session, or None if it must be replaced.
+
+        The snapshot is taken before validation, so a session Instagram rotates
+        during account_info() still counts as changed and gets saved.
+        """
+        client = Client()
+        try:
+            settings = client.load_settings(self.session_file)
+        except Exception as e:
+            print(f"Could not read saved session: {e}")
+            return None
+        client.username = self.username
+        client.password = self.password
+        loaded_state = self._auth_state(client)
+        self.stats["session_age_seconds"] = self._session_age_seconds(settings)
+        started = time.time()
+        try:
+            client.account_info()
+        except (LoginRequired, ClientLoginRequired, ClientUnauthorizedError) as e:
+            self.stats["validate_ms"] = (time.time() - started) * 1000
+            print(f"Saved session rejected ({e}); logging in again")
+            return None
+        except Exception as e:
+            # Network trouble is not an auth failure; keep the session and let later calls retry
+            print(f"Warning: could not validate saved session ({e}); using it anyway")
+        self.stats["validate_ms"] = (time.time() - started) * 1000
+        return client, loaded_state
+
+    def _fresh_login(self):
+        client = Client()
+        started = time.time()
+        try:
+            client.login(self.username, self.password)
+        except Exception as e:
+            if "Two-factor authentication required" in str(e):
+                print("Two-factor authentication is required.")
+                verification_code = input("Please enter your 2FA verification code: ")
+                try:
+                    client.login(self.username, self.password, verification_code=verification_code)
+                except Exception as e2:
+                    print(f"Login failed: {e2}")
+                    raise SystemExit(1)
+            else:
+                print(f"Login failed: {e}")
                 raise SystemExit(1)
+        self.stats["login_ms"] = (time.time() - started) * 1000
+        self.stats["session_age_seconds"] = 0.0
+        return client
+
+    def start(self):
+        restored = self._restore() if os.path.exists(self.session_file) else None
+        if restored is not None:
+            client, loaded_state = restored
+            self.stats["mode"] = "saved"
+            age_hours = self.stats["session_age_seconds"] / 3600
+            print(f"Logged in using saved session (age {age_hours:.1f} h, validated in {self.stats['validate_ms']:.0f} ms)")
         else:
-            print(f"Login failed: {e}")
-            raise SystemExit(1)
+            loaded_state = None
+            client = self._fresh_login()
+            self.stats["mode"] = "fresh"
+            print(f"Logged in with password in {self.stats['login_ms']:.0f} ms")
+        if self._auth_state(client) != loaded_state:
+            client.dump_settings(self.session_file)
+            print("Session saved")
+        return client
+
+# Timings and age of the session used by this process (see SessionManager.stats)
+session_stats = {}
+
+# Client methods that send an API request and hand back the shared last_json
+CLIENT_REQUEST_METHODS = ("private_request", "public_request", "private_graphql_request")
+
+def serialize_client_requests(client):
+    """Run `client`'s API requests one at a time, so threads can share it.
+
+    instagrapi returns each response through client attributes (last_json,
+    last_response), so two requests in flight at once can hand back each
+    other's response. Every API request takes `client.request_lock`; media
+    files are fetched with plain HTTP outside it and still run in parallel.
+    """
+    lock = threading.RLock()  # reentrant: challenge handling sends requests from inside a request
+    for name in CLIENT_REQUEST_METHODS:
+        send = getattr(client, name, None)
+        if send is None:
+            continue
+
+        def locked(*args, _send=send, **kwargs):
+            with lock:
+                return _send(*args, **kwargs)
+
+        setattr(client, name, locked)
+    client.request_lock = lock
+    return client
+
+def login_client(username, password):
+    global session_stats
+    _import_instagrapi()
+    manager = SessionManager(username, password)
+    client = serialize_client_requests(manager.start())
+    session_stats = manager.stats
+    return client
+
+# Session globals, filled in by start_session()
+secrets = None
+current_ip = None
+username = None
+cl = None
+
+def start_session(credentials=None):
+    """Check the IP allow-list, resolve credentials, log in and set up per-account state.
+
+    `credentials` ((username, password)) skips the env/per-IP lookup; farm workers use it.
+    """
+    global secrets, current_ip, username, cl
+    # Login (secured via secrets.json, optional .env, or environment variables)
+    secrets = load_secrets()
+    require_allowed_ip(secrets)
+    current_ip = get_public_ip()  # memoized by require_allowed_ip's probe
+    username, password = credentials or resolve_credentials(secrets, current_ip)
+    cl = login_client(username, password)
+    init_account_state(username)
+    return cl
 
 # Create user-specific download path based on username and IP
 def get_user_download_path(content_type, target_username=None):
@@ -197,24 +442,792 @@ def get_user_download_path(content_type, target_username=None):
     else:
         return Path("downloads") / content_type / user_folder
 
-# Track last seen message IDs
-seen_messages = set()
+class ResolutionCache:
+    """In-memory LRU backed by a SQLite table, with TTL and negative (None) entries.
+
+    Concurrent get_or_load() calls for the same key share a single loader call.
+    With db_path None the cache is memory-only (values need not be JSON).
+    A ttl of float("inf") never expires. Expired rows are pruned from disk on
+    open and every PRUNE_EVERY writes, which also keeps at most `max_stored`
+    of the most recently written rows per namespace.
+    """
+
+    PRUNE_EVERY = 500
+
+    def __init__(self, db_path, namespace, max_entries=2048, ttl=7 * 24 * 3600, negative_ttl=3600, max_stored=50000):
+        self.namespace = namespace
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.max_stored = max_stored
+        self._writes = 0
+        self._memory = OrderedDict()  # key -> (value, expires_at)
+        self._inflight = {}  # key -> _Flight
+        self._lock = threading.Lock()
+        self._db = None
+        if db_path is None:
+            return
+        try:
+            self._db = sqlite3.connect(str(db_path), check_same_thread=False)
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS cache ("
+                "namespace TEXT NOT NULL, key TEXT NOT NULL, value TEXT, expires_at REAL NOT NULL, "
+                "PRIMARY KEY (namespace, key))"
+            )
+            self._prune()
+        except Exception as e:
+            print(f"Warning: cache persistence disabled ({e})")
+            self._db = None
+
+    def _prune(self):
+        # INSERT OR REPLACE gives a rewritten row a new rowid, so rowid order is write order
+        self._db.execute(
+            "DELETE FROM cache WHERE namespace = ? AND (expires_at <= ? OR rowid NOT IN "
+            "(SELECT rowid FROM cache WHERE namespace = ? ORDER BY rowid DESC LIMIT ?))",
+            (self.namespace, time.time(), self.namespace, self.max_stored),
+        )
+        self._db.commit()
+
+    class _Flight:
+        def __init__(self):
+            self.event = threading.Event()
+            self.value = None
+            self.error = None
+
+    def _remember(self, key, value, expires_at):
+        self._memory[key] = (value, expires_at)
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.max_entries:
+            self._memory.popitem(last=False)
+
+    def get(self, key):
+        """Return (hit, value). A hit with value None is a cached negative result."""
+        now = time.time()
+        with self._lock:
+            entry = self._memory.get(key)
+            if entry is not None:
+                if entry[1] > now:
+                    self._memory.move_to_end(key)
+                    return True, entry[0]
+                del self._memory[key]
+            if self._db is None:
+                return False, None
+            try:
+                row = self._db.execute(
+                    "SELECT value, expires_at FROM cache WHERE namespace = ? AND key = ?",
+                    (self.namespace, key),
+                ).fetchone()
+            except Exception:
+                row = None
+            if not row or row[1] <= now:
+                return False, None
+            value = json.loads(row[0]) if row[0] is not None else None
+            self._remember(key, value, row[1])
+            return True, value
+
+    def put(self, key, value, ttl=None):
+        if ttl is None:
+            ttl = self.ttl if value is not None else self.negative_ttl
+        expires_at = time.time() + ttl
+        with self._lock:
+            self._remember(key, value, expires_at)
+            if self._db is None:
+                return
+            try:
+                self._db.execute(
+                    "INSERT OR REPLACE INTO cache (namespace, key, value, expires_at) VALUES (?, ?, ?, ?)",
+                    (self.namespace, key, json.dumps(value) if value is not None else None, expires_at),
+                )
+                self._db.commit()
+                self._writes += 1
+                if self._writes % self.PRUNE_EVERY == 0:
+                    self._prune()
+            except Exception as e:
+                print(f"Warning: failed to persist cache entry {key}: {e}")
+
+    def get_or_load(self, key, loader):
+        hit, value = self.get(key)
+        if hit:
+            return value
+        with self._lock:
+            flight = self._inflight.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._inflight[key] = self._Flight()
+        if not leader:
+            flight.event.wait()
+            if flight.error is not None:
+                raise flight.error
+            return flight.value
+        try:
+            # Another leader may have filled the entry while we were acquiring the flight
+            hit, value = self.get(key)
+            if not hit:
+                value = loader()
+                self.put(key, value)
+            flight.value = value
+            return value
+        except Exception as e:
+            flight.error = e
+            raise
+        finally:
+            with self._lock:
+                self._inflight.pop(key, None)
+            flight.event.set()
+
+# username (lowercase) -> user_id, persisted next to the session file
+user_id_cache = None
+
+class SenderDirectory:
+    """Bounded user_id -> username directory used when printing DMs.
+
+    Names are harvested from the user lists embedded in direct thread objects;
+    only ids that are still unknown after that get one network lookup each.
+    """
+
+    def __init__(self, cache):
+        self.cache = cache
+
+    def learn(self, user_id, uname):
+        if not user_id or not uname:
+            return
+        key = str(user_id)
+        hit, known = self.cache.get(key)
+        if hit and known == uname:
+            return
+        self.cache.put(key, uname)
+        # Reverse direction is free: seed the username -> id cache as well
+        user_id_cache.put(uname.lower(), key)
+
+    def learn_from_threads(self, api_client, threads):
+        self.learn(getattr(api_client, "user_id", None), getattr(api_client, "username", None))
+        for thread in threads or []:
+            people = list(getattr(thread, "users", None) or [])
+            people += list(getattr(thread, "left_users", None) or [])
+            inviter = getattr(thread, "inviter", None)
+            if inviter:
+                people.append(inviter)
+            for user in people:
+                self.learn(getattr(user, "pk", None), getattr(user, "username", None))
+
+    def resolve_unknown(self, api_client, user_ids):
+        for user_id in {str(u) for u in user_ids if u}:
+            hit, _ = self.cache.get(user_id)
+            if hit:
+                continue
+            try:
+                # Prefer private API to avoid public GraphQL 'data' KeyError
+                uname = api_client.user_info_v1(user_id).username
+            except Exception:
+                uname = None
+            if uname:
+                self.learn(user_id, uname)
+            else:
+                # Negative entry so a broken id is not retried every poll
+                self.cache.put(user_id, None)
+
+    def prime(self, api_client, threads):
+        """Resolve every sender in a polled batch in one pass."""
+        self.learn_from_threads(api_client, threads)
+        sender_ids = [
+            getattr(message, "user_id", None)
+            for thread in threads or []
+            for message in getattr(thread, "messages", None) or []
+        ]
+        self.resolve_unknown(api_client, sender_ids)
+
+    def name_for(self, user_id):
+        hit, uname = self.cache.get(str(user_id))
+        return uname if hit and uname else None
+
+# user_id -> username, bounded and shared by live DM printing and `show dms`
+sender_directory = None
+
+def _message_position(message):
+    """Ordering key for a direct message: (unix timestamp, numeric id)."""
+    ts = getattr(message, "timestamp", None)
+    ts = ts.timestamp() if ts else 0.0
+    message_id = str(getattr(message, "id", "") or "")
+    return ts, int(message_id) if message_id.isdigit() else 0
+
+class WatermarkStore:
+    """Per-thread high-watermark of the last processed DM, persisted atomically.
+
+    Threads without a watermark only process messages newer than the moment
+    the store was first created, so the very first run never replays history.
+    """
+
+    def __init__(self, path, max_threads=5000):
+        self.path = Path(path)
+        self.max_threads = max_threads
+        self.since = time.time()
+        self.threads = {}  # thread_id -> {"message_id": str, "timestamp": float}
+        try:
+            data = json.loads(self.path.read_text(encoding="utf-8"))
+            self.since = float(data.get("since", self.since))
+            self.threads = dict(data.get("threads", {}))
+        except FileNotFoundError:
+            self.save()
+        except Exception as e:
+            print(f"Warning: could not read {self.path} ({e}); starting fresh watermarks")
+
+    def is_new(self, thread_id, message):
+        mark = self.threads.get(str(thread_id))
+        ts, numeric_id = _message_position(message)
+        if not mark or "message_id" not in mark:
+            return ts > self.since
+        mark_id = str(mark.get("message_id", ""))
+        return (ts, numeric_id) > (mark.get("timestamp", 0.0), int(mark_id) if mark_id.isdigit() else 0)
+
+    def advance(self, thread_id, message):
+        ts, _ = _message_position(message)
+        self.threads.setdefault(str(thread_id), {}).update({"message_id": str(message.id), "timestamp": ts})
+        self._prune()
+        self.save()
+
+    def last_activity(self, thread_id):
+        """Thread activity time seen at the last completed sync (defaults to `since`)."""
+        mark = self.threads.get(str(thread_id)) or {}
+        return mark.get("last_activity", self.since)
+
+    def touch(self, thread_id, activity_ts):
+        self.threads.setdefault(str(thread_id), {})["last_activity"] = activity_ts
+        self._prune()
+
+    def _prune(self):
+        if len(self.threads) <= self.max_threads:
+            return
+        # Forget the threads that have been quiet the longest
+        def age(k):
+            mark = self.threads[k]
+            return max(mark.get("timestamp", 0.0), mark.get("last_activity", 0.0))
+        for stale in sorted(self.threads, key=age)[: len(self.threads) - self.max_threads]:
+            del self.threads[stale]
+
+    def save(self):
+        tmp_path = self.path.with_name(self.path.name + ".tmp")
+        try:
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump({"since": self.since, "threads": self.threads}, f)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_path, self.path)
+        except Exception as e:
+            print(f"Warning: failed to persist watermarks: {e}")
+
+# Last processed message per DM thread, survives restarts
+watermarks = None
+
+class InboxSync:
+    """Incremental inbox poller that only returns threads with new activity.
+
+    Each poll fetches one inbox page with a small per-thread message window and
+    stops as soon as it reaches a thread whose last activity was already synced.
+    Deeper pages are requested only while every thread seen is still changed,
+    and a thread whose window does not reach back to its watermark gets its
+    missing messages fetched on its own.
+    """
+
+    def __init__(self, store, message_window=5, gap_window=20, max_pages=5):
+        self.store = store
+        self.message_window = message_window
+        self.gap_window = gap_window
+        self.max_pages = max_pages
+        self.last_stats = {}
+
+    def _changed(self, thread):
+        activity = getattr(thread, "last_activity_at", None)
+        if not activity:
+            return True
+        return activity.timestamp() > self.store.last_activity(thread.id)
+
+    def poll(self, api_client):
+        changed = []
+        cursor = None
+        pages = 0
+        gap_fetches = 0
+        while pages < self.max_pages:
+            threads, cursor = api_client.direct_threads_chunk(
+                thread_message_limit=self.message_window, cursor=cursor
+            )
+            pages += 1
+            changed.extend(t for t in threads if self._changed(t))
+            # Inbox is ordered by activity; an unchanged tail means nothing older changed
+            # (the head is not used because pinned threads may sit there)
+            if not threads or not cursor or not self._changed(threads[-1]):
+                break
+        for thread in changed:
+            messages = getattr(thread, "messages", None) or []
+            oldest = min(messages, key=_message_position) if messages else None
+            if oldest is not None and len(messages) >= self.message_window and self.store.is_new(thread.id, oldest):
+                # Window ends before the watermark: fetch the gap for this thread only
+                try:
+                    thread.messages = api_client.direct_messages(int(thread.id), amount=self.gap_window)
+                    gap_fetches += 1
+                except Exception as e:
+                    print(f"Could not fetch older messages for thread {thread.id}: {e}")
+        self.last_stats = {"pages": pages, "changed_threads": len(changed), "gap_fetches": gap_fetches}
+        return changed
+
+    def commit(self, thread):
+        """Record a thread's activity as synced once its messages are processed."""
+        activity = getattr(thread, "last_activity_at", None)
+        if activity:
+            self.store.touch(thread.id, activity.timestamp())
+
+inbox_sync = None
+story_watch = None
+
+def init_account_state(account):
+    """Open the per-account caches and stores that live next to the session file."""
+    global user_id_cache, sender_directory, watermarks, inbox_sync, media_cache, story_watch
+    cache_db_path = f"cache_{account}.sqlite3"
+    user_id_cache = ResolutionCache(cache_db_path, "user_id")
+    # A media's pk, id and type never change; the owner (MEDIA_OWNER_TTL) and CDN URLs (their `oe`) expire on their own
+    media_cache = ResolutionCache(cache_db_path, "media", max_entries=4096, ttl=float("inf"))
+    sender_directory = SenderDirectory(ResolutionCache(cache_db_path, "username", max_entries=1024, ttl=24 * 3600))
+    watermarks = WatermarkStore(f"watermarks_{account}.json")
+    inbox_sync = InboxSync(watermarks)
+    rate_governor.load(f"ratelimits_{account}.json")
+    story_watch = StoryWatchList(f"story_watch_{account}.json")
+
+def _is_rate_limited(error):
+    if isinstance(error, (PleaseWaitFewMinutes, RateLimitError, ClientThrottledError)):
+        return True
+    # instagrapi and requests errors carry the HTTP response; ids and URLs in the message may contain "429"
+    response = getattr(error, "response", None)
+    if getattr(response, "status_code", None) == 429:
+        return True
+    text = str(error).lower()
+    return "please wait" in text or "rate limit" in text
+
+# Set when the bot is shutting down: queue drains and rate-limit waits return early
+shutdown_event = threading.Event()
+
+class PollScheduler:
+    """Adaptive inbox polling plus independent cadences for the queue drains.
+
+    The inbox interval drops to `min_interval` right after a command arrives,
+    doubles (with jitter) on every idle poll up to `max_interval`, and backs
+    off much harder on rate-limit or connection errors.
+    """
+
+    def __init__(self, min_interval=5.0, max_interval=120.0, error_max_interval=900.0, jitter=0.2):
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.error_max_interval = error_max_interval
+        self.jitter = jitter
+        self.interval = min_interval
+        self.next_inbox_at = time.time()
+        self.tasks = {}  # name -> {"func", "period", "next_due", "runs"}
+        self.polls = 0
+        self.idle_polls = 0
+        self.error_streak = 0
+        self.last_error = None
+        self.last_poll_at = None
+        self._wake = None  # thread-safe callback installed by BotRuntime
+        self._lock = threading.Lock()
+
+    def add_task(self, name, func, period):
+        self.tasks[name] = {"func": func, "period": period, "next_due": time.time(), "runs": 0}
+
+    def _jittered(self, seconds):
+        return seconds * random.uniform(1 - self.jitter, 1 + self.jitter)
+
+    def note_activity(self):
+        """A command just arrived: poll again soon and wake the inbox task if it is sleeping."""
+        with self._lock:
+            self.idle_polls = 0
+            self.interval = self.min_interval
+            self.next_inbox_at = min(self.next_inbox_at, time.time() + self.min_interval)
+        if self._wake:
+            self._wake()
+
+    def _after_poll(self, commands):
+        with self._lock:
+            self.polls += 1
+            self.error_streak = 0
+            self.last_poll_at = time.time()
+            if commands:
+                self.idle_polls = 0
+                self.interval = self.min_interval
+            else:
+                self.idle_polls += 1
+                self.interval = min(self.max_interval, self.interval * 2)
+            self.next_inbox_at = time.time() + self._jittered(self.interval)
+
+    def _after_error(self, error):
+        with self._lock:
+            self.error_streak += 1
+            self.last_error = f"{type(error).__name__}: {error}"
+            base = self.max_interval if _is_rate_limited(error) else self.min_interval * 4
+            self.interval = min(self.error_max_interval, base * 2 ** (self.error_streak - 1))
+            self.next_inbox_at = time.time() + self._jittered(self.interval)
+        print(f"Inbox fetch error: {error} (next poll in {int(self.interval)}s)")
+
+    def status(self):
+        now = time.time()
+        with self._lock:
+            return {
+                "interval": round(self.interval, 1),
+                "next_inbox_in": max(0, round(self.next_inbox_at - now, 1)),
+                "polls": self.polls,
+                "idle_polls": self.idle_polls,
+                "error_streak": self.error_streak,
+                "last_error": self.last_error,
+                "tasks": {
+                    name: {"period": t["period"], "next_in": max(0, round(t["next_due"] - now, 1)), "runs": t["runs"]}
+                    for name, t in self.tasks.items()
+                },
+            }
+
+scheduler = PollScheduler(
+    min_interval=float(os.environ.get("POLL_MIN_SECONDS", "5")),
+    max_interval=float(os.environ.get("POLL_MAX_SECONDS", "120")),
+)
+
+BOT_WORKERS = int(os.environ.get("BOT_WORKERS", "6"))
+BOT_DRAIN_SLOTS = 2  # queue drains running at once; the other workers stay free for inbox/terminal
+SHUTDOWN_GRACE_SECONDS = 30
+
+class BotRuntime:
+    """asyncio runtime for bot mode: the inbox poll, each scheduled queue drain and
+    the terminal session run as separate tasks.
+
+    Blocking instagrapi calls are offloaded to a bounded thread pool; the tasks
+    share one client whose API requests are serialized (serialize_client_requests),
+    so only rate-governor waits and media transfers actually overlap. Queue drains
+    only get `drain_slots` of its threads, so a long upload or a drain waiting on
+    the rate governor never delays inbox polling or terminal commands.
+    SIGINT/SIGTERM cancel the tasks, let in-flight calls finish and save the
+    inbox watermarks.
+    """
+
+    def __init__(self, api_client, scheduler, workers=BOT_WORKERS, drain_slots=BOT_DRAIN_SLOTS):
+        self.api_client = api_client
+        self.scheduler = scheduler
+        self.drain_slots = drain_slots
+        self.executor = ThreadPoolExecutor(max_workers=max(workers, drain_slots + 2), thread_name_prefix="bot")
+        self.error = None
+        self.loop = None
+        self.stopping = None
+
+    async def offload(self, func, *args):
+        return await self.loop.run_in_executor(self.executor, func, *args)
+
+    async def _sleep(self, seconds, wake=None):
+        """Sleep up to `seconds`; returns early when `wake` is set."""
+        if wake is None:
+            await asyncio.sleep(max(0.0, seconds))
+            return
+        try:
+            await asyncio.wait_for(wake.wait(), max(0.0, seconds))
+        except asyncio.TimeoutError:
+            pass
+        wake.clear()
+
+    async def _inbox(self, poll):
+        s = self.scheduler
+        while True:
+            if time.time() < s.next_inbox_at:
+                await self._sleep(s.next_inbox_at - time.time(), self._inbox_wake)
+                continue
+            try:
+                s._after_poll(await self.offload(poll, self.api_client))
+            except (ClientConnectionError, requests.exceptions.RequestException) as e:
+                s._after_error(e)
+            except Exception as e:
+                if not _is_rate_limited(e):
+                    raise
+                s._after_error(e)
+
+    async def _scheduled(self, name):
+        task = self.scheduler.tasks[name]
+        while True:
+            await self._sleep(task["next_due"] - time.time())
+            async with self._drain_slots:
+                try:
+                    await self.offload(task["func"], self.api_client)
+                except Exception as e:
+                    print(f"Scheduled task {name} failed: {e}")
+            task["runs"] += 1
+            task["next_due"] = time.time() + task["period"]
+
+    def _read_terminal(self, lines):
+        # input() can't be cancelled, so it lives in a daemon thread instead of the pool
+        while True:
+            try:
+                line = input("> ")
+            except (EOFError, KeyboardInterrupt):
+                line = None
+            self.loop.call_soon_threadsafe(lines.put_nowait, line)
+            if line is None:
+                return
+
+    async def _terminal(self):
+        print("Command session started. Type commands or 'help'/'exit'.")
+        lines = asyncio.Queue()
+        threading.Thread(target=self._read_terminal, args=(lines,), daemon=True).start()
+        while True:
+            line = await lines.get()
+            if line is None:
+                print("\nCommand session closed.")
+                return
+            line = line.strip()
+            if not line:
+                continue
+            if line.lower() in ("exit", "quit"):
+                print("Exiting command session (bot continues running).")
+                return
+            if line.lower() in ("help", "h", "?"):
+                print("Commands:")
+                for usage in command_registry.help_lines():
+                    print(f"  {usage}")
+                continue
+            try:
+                handled = await self.offload(try_parse_and_execute_commands, self.api_client, line)
+            except Exception as e:
+                print(f"Command failed: {type(e).__name__}: {e}")
+                continue
+            if handled:
+                self.scheduler.note_activity()
+            else:
+                print("Unknown command. Type 'help' for options.")
+
+    async def _guard(self, name, coro):
+        try:
+            await coro
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            print(f"{name} task crashed: {type(e).__name__}: {e}; shutting down")
+            self.error = self.error or e
+            self.stopping.set()
+
+    async def run(self, poll, interactive=True):
+        self.loop = asyncio.get_running_loop()
+        self.stopping = asyncio.Event()
+        self._inbox_wake = asyncio.Event()
+        self._drain_slots = asyncio.Semaphore(self.drain_slots)
+        self.scheduler._wake = lambda: self.loop.call_soon_threadsafe(self._inbox_wake.set)
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            try:
+                self.loop.add_signal_handler(sig, self.stopping.set)
+            except (NotImplementedError, RuntimeError):
+                pass  # Windows: Ctrl+C arrives as KeyboardInterrupt instead
+        tasks = [asyncio.create_task(self._guard("inbox", self._inbox(poll)))]
+        tasks += [asyncio.create_task(self._guard(name, self._scheduled(name))) for name in self.scheduler.tasks]
+        if interactive:
+            # Closing the terminal session leaves the bot running, so it is not guarded
+            tasks.append(asyncio.create_task(self._terminal()))
+        try:
+            await self.stopping.wait()
+        finally:
+            print("Shutting down: letting in-flight Instagram calls finish...")
+            shutdown_event.set()
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            drained = self.loop.run_in_executor(None, lambda: self.executor.shutdown(wait=True, cancel_futures=True))
+            try:
+                await asyncio.wait_for(drained, SHUTDOWN_GRACE_SECONDS)
+            except asyncio.TimeoutError:
+                print(f"Some calls were still running after {SHUTDOWN_GRACE_SECONDS}s; exiting anyway")
+            if watermarks is not None:
+                watermarks.save()
+            self.scheduler._wake = None
+        if self.error is not None:
+            raise self.error
+class RateLimitExceeded(Exception):
+    """An action's budget is exhausted for longer than the caller is willing to wait."""
+
+# action: (per hour, per day, burst)
+RATE_LIMITS = {
+    "follow": (20, 150, 3),
+    "unfollow": (20, 150, 3),
+    "like": (60, 500, 5),
+    "comment": (15, 100, 2),
+    "dm": (30, 150, 3),
+    "upload": (5, 25, 1),
+}
+GLOBAL_RATE_LIMIT = (150, 1000, 5)
+RATE_SPACING = (2.0, 6.0)  # random pause between any two actions, seconds
+# Cooldown applied to every action after Instagram pushes back, seconds
+RATE_COOLDOWNS = (
+    (lambda e: isinstance(e, FeedbackRequired) or "feedback_required" in str(e).lower(), 3600),
+    (lambda e: isinstance(e, PleaseWaitFewMinutes) or "please wait" in str(e).lower(), 600),
+    (_is_rate_limited, 900),
+)
+
+class _Budget:
+    """Token bucket plus rolling hourly/daily counters for one action (or all of them)."""
+
+    def __init__(self, per_hour, per_day, burst):
+        self.per_hour = per_hour
+        self.per_day = per_day
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated = time.time()
+        self.history = deque()  # action timestamps within the last day
+
+    def _refill(self, now):
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.per_hour / 3600)
+        self.updated = now
+        while self.history and self.history[0] <= now - 86400:
+            self.history.popleft()
+
+    def used_last_hour(self, now):
+        return sum(1 for ts in self.history if ts > now - 3600)
+
+    def wait_needed(self, now):
+        self._refill(now)
+        waits = [0.0]
+        if self.tokens < 1:
+            waits.append((1 - self.tokens) * 3600 / self.per_hour)
+        recent = [ts for ts in self.history if ts > now - 3600]
+        if len(recent) >= self.per_hour:
+            waits.append(recent[len(recent) - self.per_hour] + 3600 - now)
+        if len(self.history) >= self.per_day:
+            waits.append(self.history[len(self.history) - self.per_day] + 86400 - now)
+        return max(waits)
+
+    def consume(self, now):
+        self.tokens -= 1
+        self.history.append(now)
+
+class RateGovernor:
+    """Thread-safe pacing for every Instagram write action.
+
+    Each action has its own token bucket and hourly/daily caps, all actions share
+    a global budget, consecutive actions are spaced by a random pause, and
+    feedback-required / please-wait responses put everything on cooldown.
+    Action history is persisted so daily caps survive restarts.
+    """
+
+    def __init__(self, limits, global_limit, spacing=RATE_SPACING, max_wait=90.0):
+        self.budgets = {action: _Budget(*limit) for action, limit in limits.items()}
+        self.global_budget = _Budget(*global_limit)
+        self.spacing = spacing
+        self.max_wait = max_wait
+        self.cooldown_until = 0.0
+        self.cooldown_reason = None
+        self.next_slot = 0.0
+        self.state_path = None
+        self._lock = threading.Lock()
+
+    def load(self, path):
+        self.state_path = Path(path)
+        try:
+            data = json.loads(self.state_path.read_text(encoding="utf-8"))
+        except FileNotFoundError:
+            return
+        except Exception as e:
+            print(f"Warning: could not read {self.state_path} ({e}); rate history reset")
+            return
+        now = time.time()
+        with self._lock:
+            self.cooldown_until = float(data.get("cooldown_until", 0.0))
+            self.cooldown_reason = data.get("cooldown_reason")
+            for action, stamps in data.get("history", {}).items():
+                if action in self.budgets:
+                    recent = sorted(ts for ts in stamps if ts > now - 86400)
+                    self.budgets[action].history = deque(recent)
+                    self.global_budget.history.extend(recent)
+            self.global_budget.history = deque(sorted(self.global_budget.history))
+
+    def _save(self):
+        if self.state_path is None:
+            return
+        data = {
+            "cooldown_until": self.cooldown_until,
+            "cooldown_reason": self.cooldown_reason,
+            "history": {action: list(budget.history) for action, budget in self.budgets.items()},
+        }
+        tmp_path = self.state_path.with_name(self.state_path.name + ".tmp")
+        try:
+            tmp_path.write_text(json.dumps(data), encoding="utf-8")
+            os.replace(tmp_path, self.state_path)
+        except Exception as e:
+            print(f"Warning: failed to persist rate limits: {e}")
+
+    def _wait_needed(self, action, now):
+        return max(
+            self.cooldown_until - now,
+            self.next_slot - now,
+            self.budgets[action].wait_needed(now),
+            self.global_budget.wait_needed(now),
+        )
+
+    def acquire(self, action, max_wait=None):
+        """Block until `action` may run, or raise RateLimitExceeded if that is too far away."""
+        max_wait = self.max_wait if max_wait is None else max_wait
+        while True:
+            with self._lock:
+                now = time.time()
+                wait = self._wait_needed(action, now)
+                if wait <= 0:
+                    self.budgets[action].consume(now)
+                    self.global_budget.consume(now)
+                    self.next_slot = now + random.uniform(*self.spacing)
+                    self._save()
+                    return
+            if wait > max_wait:
+                raise RateLimitExceeded(f"{action} budget exhausted; next slot in {int(wait // 60)}m{int(wait % 60):02d}s")
+            if shutdown_event.wait(wait):
+                raise RateLimitExceeded(f"{action} skipped: shutting down")
+
+    def report_error(self, error):
+        for matches, seconds in RATE_COOLDOWNS:
+            if matches(error):
+                with self._lock:
+                    self.cooldown_until = max(self.cooldown_until, time.time() + seconds)
+                    self.cooldown_reason = f"{type(error).__name__}: {error}"
+                    self._save()
+                print(f"Instagram pushed back ({type(error).__name__}); pausing all actions for {seconds // 60} min")
+                return
+
+    @contextmanager
+    def action(self, name):
+        self.acquire(name)
+        try:
+            yield
+        except Exception as e:
+            self.report_error(e)
+            raise
+
+    def remaining(self):
+        now = time.time()
+        with self._lock:
+            report = {}
+            for action, budget in list(self.budgets.items()) + [("all", self.global_budget)]:
+                wait = budget.wait_needed(now)
+                report[action] = {
+                    "hour_left": max(0, budget.per_hour - budget.used_last_hour(now)),
+                    "day_left": max(0, budget.per_day - len(budget.history)),
+                    "next_in": max(0.0, wait, self.cooldown_until - now),
+                }
+            return report, max(0.0, self.cooldown_until - now), self.cooldown_reason
+
+rate_governor = RateGovernor(RATE_LIMITS, GLOBAL_RATE_LIMIT)
+
 # Control whether to print DMs continuously
 PRINT_DMS = False
-# Control whether to resolve user_id -> username via network (may block)
-RESOLVE_USERNAMES = False
+# Control whether to show usernames instead of numeric ids when printing DMs
+RESOLVE_USERNAMES = True
 
 def safe_username(api_client, user_id):
     if not RESOLVE_USERNAMES:
         return str(user_id)
-    try:
-        # Prefer private API to avoid public GraphQL 'data' KeyError
-        return api_client.user_info_v1(user_id).username
-    except Exception:
-        return str(user_id)
+    uname = sender_directory.name_for(user_id)
+    if uname is None:
+        # Not primed from a thread batch; fall back to a single lookup
+        sender_directory.resolve_unknown(api_client, [user_id])
+        uname = sender_directory.name_for(user_id)
+    return uname or str(user_id)
 
-def get_user_id_from_username(api_client, username):
-    uname = username.lstrip("@")
+def _lookup_user_id(api_client, uname):
+    """Resolve a username over the network; returns None if the user does not exist."""
     # Prefer private search to avoid public GQL paths
     try:
         users = api_client.search_users(uname)
@@ -223,19 +1236,615 @@ def get_user_id_from_username(api_client, username):
             cand = exact or users[0]
             user_pk = getattr(cand, "pk", None) or getattr(cand, "id", None)
             if user_pk:
-                return user_pk
+                return str(user_pk)
     except Exception:
         pass
     # Fallback to library method if available
     try:
-        return api_client.user_id_from_username(uname)
-    except Exception as e:
-        raise e
+        return str(api_client.user_id_from_username(uname))
+    except UserNotFound:
+        return None
+
+# shortcode -> media identity; ids and types never change, owner usernames can
+media_cache = None
+MEDIA_OWNER_TTL = 24 * 3600
 
-def download_from_url(api_client, url):
-    """Download story, reel, or post from Instagram URL"""
+def _media_cache_key(url):
+    path = urlparse(str(url)).path
+    m = re.search(r"/(?:p|reel|reels|tv)/([A-Za-z0-9_-]+)", path)
+    if m:
+        return m.group(1)[:11]  # shortcode; longer private-share codes share the same prefix
+    m = re.search(r"/stories/[^/]+/(\d+)", path)
+    if m:
+        return f"story:{m.group(1)}"
+    return str(url).split("?", 1)[0].rstrip("/")
+
+def _media_links(media):
+    """The CDN URL fields of a Media or Resource object, as plain strings."""
+    return {name: str(getattr(media, name, None) or "") or None for name in ("thumbnail_url", "video_url")}
+
+def remember_media(media, key=None):
+    """Cache a Media object's identity and CDN URLs under its shortcode (and `key`, if given); returns the entry.
+
+    The URLs (and carousel resources) let the download planner fetch the
+    files directly instead of calling media_info again; _media_url() ignores
+    them once their signed `oe` expiry has passed.
+    """
+    user = getattr(media, "user", None)
+    info = {
+        "pk": str(media.pk),
+        "media_id": str(media.id),
+        "code": getattr(media, "code", None),
+        "owner_id": str(getattr(user, "pk", "") or ""),
+        "owner_username": getattr(user, "username", None),
+        "owner_checked_at": time.time(),
+        "media_type": getattr(media, "media_type", None),
+        "product_type": getattr(media, "product_type", None) or "",
+        **_media_links(media),
+        "resources": [
+            {"pk": str(r.pk), "media_type": r.media_type, **_media_links(r)} for r in getattr(media, "resources", None) or []
+        ],
+    }
+    for cache_key in {key, info["code"]} - {None}:
+        media_cache.put(cache_key, info)
+    return info
+
+def resolve_media(api_client, url, need_owner=False):
+    """Identity of the media behind `url`: pk, media_id, owner, media_type, product_type.
+
+    Served from the media cache when possible; otherwise one media_info call
+    fills the cache for every later like/comment/download of the same URL.
+    """
+    key = _media_cache_key(url)
+    hit, info = media_cache.get(key)
+    if hit and info and (not need_owner or time.time() - info.get("owner_checked_at", 0) < MEDIA_OWNER_TTL):
+        return info
+    media_pk = info["pk"] if hit and info else api_client.media_pk_from_url(url)
+    media = api_client.media_info(media_pk)
+    # Never file a response under this URL's key unless it is the media we asked for
+    if str(media.pk) != str(media_pk):
+        raise ValueError(f"media_info({media_pk}) returned media {media.pk}")
+    return remember_media(media, key)
+
+def get_user_id_from_username(api_client, username):
+    uname = username.lstrip("@")
+    user_id = user_id_cache.get_or_load(uname.lower(), lambda: _lookup_user_id(api_client, uname))
+    if not user_id:
+        raise UserNotFound(f"User not found: @{uname}")
+    return user_id
+
+MEDIA_INDEX_TTL = 300  # seconds a user's first feed page answers "latest" queries
+MEDIA_INDEX_PAGE = 12  # one feed page
+REEL_PRODUCT_TYPES = ("clips", "reel", "clips_together")
+
+def _taken_at(media):
+    taken_at = getattr(media, "taken_at", None)
+    return taken_at.timestamp() if taken_at else 0
+
+class LatestMediaIndex:
+    """Newest-first first feed page per user, with "posts" and "reels" views.
+
+    One user_medias request per user and TTL serves every like/download
+    "latest" command; the views are sorted once when the page is loaded, so a
+    lookup is just the head of a list. Reels fall back to one user_clips page
+    only when the feed page has none (e.g. pinned posts pushed them off).
+    """
+
+    def __init__(self, ttl=MEDIA_INDEX_TTL, page=MEDIA_INDEX_PAGE):
+        self.page = page
+        self._cache = ResolutionCache(None, "latest_media", max_entries=256, ttl=ttl, negative_ttl=ttl)
+        self._lock = threading.Lock()
+        self.stats = {"lookups": 0, "feed_requests": 0, "clips_requests": 0}
+
+    def _load(self, api_client, user_id):
+        with self._lock:
+            self.stats["feed_requests"] += 1
+        medias = sorted(api_client.user_medias(user_id, amount=self.page) or [], key=_taken_at, reverse=True)
+        for media in medias:
+            remember_media(media)
+        reels = [m for m in medias if str(getattr(m, "product_type", "")).lower() in REEL_PRODUCT_TYPES]
+        return {
+            "posts": [m for m in medias if str(getattr(m, "product_type", "")).lower() not in ("clips", "igtv")],
+            "reels": reels or None,  # None: ask user_clips on first use
+        }
+
+    def medias(self, api_client, user_id, view):
+        """Newest-first medias of `user_id` for `view` ("posts" or "reels")."""
+        with self._lock:
+            self.stats["lookups"] += 1
+        entry = self._cache.get_or_load(str(user_id), lambda: self._load(api_client, user_id))
+        if view == "reels" and entry["reels"] is None:
+            with self._lock:
+                self.stats["clips_requests"] += 1
+            clips = api_client.user_clips(user_id, amount=self.page) or []
+            entry["reels"] = sorted(clips, key=_taken_at, reverse=True)
+        return entry[view]
+
+    def latest(self, api_client, user_id, view):
+        medias = self.medias(api_client, user_id, view)
+        return medias[0] if medias else None
+
+latest_media = LatestMediaIndex()
+
+# Shared bounded pool for media downloads; every download path submits here
+DOWNLOAD_WORKERS = max(1, int(os.environ.get("DOWNLOAD_WORKERS", "4")))
+_download_pool = ThreadPoolExecutor(max_workers=DOWNLOAD_WORKERS, thread_name_prefix="download")
+
+def download_many(jobs):
+    """Run (name, callable) download jobs on the shared pool and summarize the results.
+
+    A failing job is reported and recorded without affecting the others. Must not
+    be called from inside a job, since the pool is bounded.
+    """
+    started = time.time()
+    futures = {_download_pool.submit(func): name for name, func in jobs}
+    ok, failed = [], []
+    for future in as_completed(futures):
+        name = futures[future]
+        try:
+            ok.append((name, future.result()))
+        except Exception as e:
+            failed.append((name, e))
+            print(f"✗ Failed to download {name}: {e}")
+    return {"ok": ok, "failed": failed, "seconds": time.time() - started}
+
+def format_download_summary(summary):
+    done = len(summary["ok"])
+    total = done + len(summary["failed"])
+    # Blob store jobs return (paths, fetched); unfetched ones were already on disk
+    cached = sum(1 for _, result in summary["ok"] if isinstance(result, tuple) and result[1] is False)
+    on_disk = f" ({cached} already on disk)" if cached else ""
+    return f"{done}/{total} downloaded{on_disk} in {summary['seconds']:.1f}s"
+
+MEDIA_CHUNK_SIZE = 256 * 1024
+MEDIA_TIMEOUT = (5, 30)  # (connect, read) seconds
+
+def _url_extension(url, default=".jpg"):
+    suffix = Path(urlparse(str(url)).path).suffix.lower()
+    return ".jpg" if suffix == ".jpeg" else (suffix or default)
+
+def fetch_media(url, dest, max_attempts=3):
+    """Stream a media URL to `dest` without buffering it in memory.
+
+    Bytes go to `<dest>.part` in fixed-size chunks; an interrupted transfer is
+    resumed with an HTTP Range request, the final size is checked against
+    Content-Length, and the file is renamed into place only when complete.
+    Returns the destination Path.
+    """
+    dest = Path(dest)
+    part = dest.with_name(dest.name + ".part")
+    last_error = None
+    for attempt in range(1, max_attempts + 1):
+        offset = part.stat().st_size if part.exists() else 0
+        headers = {"Range": f"bytes={offset}-"} if offset else {}
+        try:
+            with http_get(str(url), headers=headers, stream=True, timeout=MEDIA_TIMEOUT) as response:
+                if response.status_code == 416 and offset:
+                    # Partial file is already complete (or invalid): start over
+                    part.unlink()
+                    continue
+                response.raise_for_status()
+                if offset and response.status_code != 206:
+                    offset = 0  # Server ignored the Range header
+                expected = response.headers.get("Content-Length")
+                expected = offset + int(expected) if expected and expected.isdigit() else None
+                with open(part, "ab" if offset else "wb") as f:
+                    for chunk in response.iter_content(chunk_size=MEDIA_CHUNK_SIZE):
+                        if chunk:
+                            f.write(chunk)
+            size = part.stat().st_size
+            if expected is not None and size != expected:
+                raise IOError(f"incomplete download ({size} of {expected} bytes)")
+            os.replace(part, dest)
+            return dest
+        except requests.exceptions.HTTPError:
+            raise
+        except (requests.exceptions.RequestException, IOError) as e:
+            last_error = e
+            if attempt < max_attempts:
+                time.sleep(attempt)
+    raise last_error or IOError(f"failed to download {url}")
+
+def _file_digest(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+_carousel_pool = ThreadPoolExecutor(max_workers=DOWNLOAD_WORKERS, thread_name_prefix="carousel")
+download_planner_stats = {"planned": 0, "guessed": 0, "avoided_calls": 0}
+_planner_lock = threading.Lock()
+
+def _media_field(media, name):
+    return media.get(name) if isinstance(media, dict) else getattr(media, name, None)
+
+def _media_url(media):
+    """Download URL of a media or carousel item, or None if unknown or past its CDN expiry."""
+    url = _media_field(media, "video_url") if _media_field(media, "media_type") == 2 else _media_field(media, "thumbnail_url")
+    if not url:
+        return None
+    url = str(url)
+    # Instagram CDN URLs are signed with a hex expiry timestamp in `oe`
+    expiry = re.search(r"[?&]oe=([0-9A-Fa-f]+)", url)
+    if expiry and int(expiry.group(1), 16) < time.time() + 60:
+        return None
+    return url
+
+def download_carousel(api_client, pk, resources, out_dir, owner):
+    """Fetch every carousel child in parallel (named like instagrapi's album_download); returns their Paths."""
+    if not resources or not all(_media_url(r) for r in resources):
+        resources = api_client.media_info(pk).resources
+    futures = []
+    for resource in resources:
+        url = _media_url(resource)
+        default_ext = ".mp4" if _media_field(resource, "media_type") == 2 else ".jpg"
+        dest = Path(out_dir) / f"{owner}_{_media_field(resource, 'pk')}{_url_extension(url, default_ext)}"
+        futures.append(_carousel_pool.submit(fetch_media, url, dest))
+    # Wait for all of them so a failure never leaves children downloading in the background
+    errors = [f.exception() for f in futures]
+    failed = [e for e in errors if e is not None]
+    if failed:
+        raise IOError(f"{len(failed)} of {len(futures)} carousel items failed: {failed[0]}")
+    return [f.result() for f in futures]
+
+def plan_media_download(api_client, media, out_dir, owner):
+    """Pick the single download call that fits `media`, from metadata the bot already has.
+
+    `media` is a Media object (user_medias, user_clips, media_info) or a
+    resolve_media() entry; both carry CDN URLs while they are fresh. Returns
+    (kind, fetch, avoided): fetch() returns the written Path(s) for
+    BlobStore.download, and `avoided` counts only the calls this plan really
+    skips compared with the photo→video→album guessing (failed attempts and
+    the media_info lookups those calls make). kind is None when the type is
+    unknown.
+    """
+    pk = str(_media_field(media, "pk"))
+    media_type = _media_field(media, "media_type")
+    product_type = (_media_field(media, "product_type") or "").lower()
+    folder = str(out_dir)
+    url = _media_url(media)
+    # With a fresh CDN URL the media_info lookup inside photo/video_download is skipped too
+    known_url = 1 if url else 0
+    if media_type == 1:
+        if url:
+            return "Photo", lambda: fetch_media(url, Path(out_dir) / f"{owner}_{pk}{_url_extension(url)}"), known_url
+        return "Photo", lambda: api_client.photo_download(pk, folder=folder), 0
+    if media_type == 2:
+        kind = "Reel" if product_type == "clips" else "Video"
+        if url:
+            return kind, lambda: fetch_media(url, Path(out_dir) / f"{owner}_{pk}{_url_extension(url, '.mp4')}"), 1 + known_url
+        return kind, lambda: api_client.video_download(pk, folder=folder), 1
+    if media_type == 8:
+        resources = _media_field(media, "resources")
+        known_resources = 1 if resources and all(_media_url(r) for r in resources) else 0
+        return "Album", lambda: download_carousel(api_client, pk, resources, out_dir, owner), 2 + known_resources
+    return None, None, 0
+
+def _guess_media_download(api_client, pk, out_dir):
+    """Fallback for media of unknown type: try photo, then video, then album."""
+    folder = str(out_dir)
     try:
-        print(f"Processing URL: {url}")
+        return "Photo", api_client.photo_download(pk, folder=folder)
+    except Exception as photo_error:
+        try:
+            return "Video", api_client.video_download(pk, folder=folder)
+        except Exception as video_error:
+            try:
+                return "Album", api_client.album_download(pk, folder=folder)
+            except Exception as album_error:
+                raise Exception(f"as photo ({photo_error}), video ({video_error}), or album ({album_error})")
+
+def download_media(api_client, media, out_dir, owner, content_type):
+    """Download one post/reel through the planner and the blob store; returns (kind, paths, fetched, avoided)."""
+    kind, fetch, avoided = plan_media_download(api_client, media, out_dir, owner)
+    guessed = {}
+
+    def run():
+        with _planner_lock:
+            download_planner_stats["planned" if kind else "guessed"] += 1
+            download_planner_stats["avoided_calls"] += avoided
+        if fetch is not None:
+            return fetch()
+        guessed["kind"], paths = _guess_media_download(api_client, str(_media_field(media, "pk")), out_dir)
+        return paths
+
+    paths, fetched = blob_store().download(_media_field(media, "pk"), out_dir, run, owner=owner, media_type=content_type)
+    if not fetched:
+        return "Already stored; linked", paths, False, 0
+    return kind or guessed.get("kind"), paths, True, avoided
+
+BLOB_DIR = Path("downloads") / ".blobs"
+BLOB_VERIFY_PERIOD = 600  # seconds between background integrity passes
+BLOB_VERIFY_BATCH = 50  # blobs re-hashed per pass, least recently verified first
+
+class BlobStore:
+    """Content-addressed store and download manifest for downloaded media.
+
+    Files live once under `<root>/<sha[:2]>/<sha><ext>` and are exposed in the
+    per-user download folders as hardlinks (symlinks, then copies, where the
+    filesystem can't link). The SQLite index maps media pks to their blobs, so a
+    repeat download is served from disk without any network fetch, and keeps a
+    manifest row (pk, owner, type, size, fetch time) for every file placed under
+    downloads/. A blob that fails verification is moved to `<root>/quarantine`
+    and forgotten, so the next request fetches it again; the user's files are
+    never deleted in the background.
+    """
+
+    def __init__(self, root=BLOB_DIR):
+        self.root = Path(root)
+        self.root.mkdir(parents=True, exist_ok=True)
+        self._lock = threading.Lock()
+        self._verifier = None
+        self._db = sqlite3.connect(str(self.root / "index.sqlite3"), check_same_thread=False, timeout=30)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.executescript(
+            "CREATE TABLE IF NOT EXISTS blobs (sha256 TEXT PRIMARY KEY, ext TEXT NOT NULL, size INTEGER NOT NULL, verified_at REAL NOT NULL);"
+            "CREATE TABLE IF NOT EXISTS media (key TEXT NOT NULL, position INTEGER NOT NULL, sha256 TEXT NOT NULL, name TEXT NOT NULL, PRIMARY KEY (key, position));"
+            "CREATE TABLE IF NOT EXISTS manifest ("
+            "path TEXT PRIMARY KEY, sha256 TEXT NOT NULL, pk TEXT, owner TEXT, media_type TEXT, size INTEGER NOT NULL, fetched_at REAL NOT NULL);"
+            "CREATE INDEX IF NOT EXISTS manifest_sha256 ON manifest (sha256);"
+            "CREATE INDEX IF NOT EXISTS manifest_owner ON manifest (owner, fetched_at);"
+            "CREATE INDEX IF NOT EXISTS manifest_pk ON manifest (pk);"
+        )
+        self._db.commit()
+
+    def _blob_path(self, sha256, ext):
+        return self.root / sha256[:2] / f"{sha256}{ext}"
+
+    def lookup(self, key):
+        """[(blob path, file name)] stored for `key`, or None when anything is missing."""
+        with self._lock:
+            rows = self._db.execute(
+                "SELECT b.sha256, b.ext, m.name FROM media m JOIN blobs b ON b.sha256 = m.sha256 WHERE m.key = ? ORDER BY m.position",
+                (str(key),),
+            ).fetchall()
+        found = [(self._blob_path(sha256, ext), name) for sha256, ext, name in rows]
+        if not found or not all(blob.exists() for blob, _ in found):
+            return None
+        return found
+
+    @staticmethod
+    def _place(blob, dest):
+        """Make `dest` a hardlink to `blob` (or a symlink, or a copy)."""
+        dest = Path(dest)
+        if dest.exists() and os.path.samefile(blob, dest):
+            return dest
+        tmp = dest.with_name(dest.name + ".link")
+        tmp.unlink(missing_ok=True)
+        try:
+            os.link(blob, tmp)
+        except OSError:
+            try:
+                os.symlink(blob.resolve(), tmp)
+            except OSError:
+                shutil.copy2(blob, tmp)
+        os.replace(tmp, dest)
+        return dest
+
+    def ingest(self, path):
+        """Move a freshly downloaded file into the store and leave a link in its place; returns its sha256."""
+        path = Path(path)
+        sha256 = _file_digest(path)
+        blob = self._blob_path(sha256, path.suffix.lower())
+        if not blob.exists():
+            blob.parent.mkdir(parents=True, exist_ok=True)
+            tmp = blob.with_name(blob.name + ".tmp")
+            try:
+                os.link(path, tmp)
+            except OSError:
+                shutil.copy2(path, tmp)
+            os.replace(tmp, blob)
+        with self._lock:
+            self._db.execute(
+                "INSERT OR IGNORE INTO blobs (sha256, ext, size, verified_at) VALUES (?, ?, ?, ?)",
+                (sha256, blob.suffix, blob.stat().st_size, time.time()),
+            )
+            self._db.commit()
+        # Same content already stored: swap the new copy for a link
+        self._place(blob, path)
+        return sha256
+
+    @staticmethod
+    def _manifest_path(path):
+        """The one spelling a file gets in the manifest: relative to the working directory when inside it."""
+        path = Path(os.path.abspath(path))
+        cwd = Path.cwd()
+        return str(path.relative_to(cwd)) if path.is_relative_to(cwd) else str(path)
+
+    def _in_store(self, path):
+        path = Path(path).resolve()
+        root = self.root.resolve()
+        return path == root or root in path.parents
+
+    def _record(self, key, entries, owner, media_type, fetched_at=None, replace_media=True):
+        """Write the media mapping and manifest rows for `entries` ([(sha256, path)]) in one transaction."""
+        fetched_at = fetched_at or time.time()
+        with self._lock, self._db:
+            if key is not None and replace_media:
+                self._db.execute("DELETE FROM media WHERE key = ?", (str(key),))
+                self._db.executemany(
+                    "INSERT INTO media (key, position, sha256, name) VALUES (?, ?, ?, ?)",
+                    [(str(key), i, sha256, Path(path).name) for i, (sha256, path) in enumerate(entries)],
+                )
+            self._db.executemany(
+                "INSERT OR REPLACE INTO manifest (path, sha256, pk, owner, media_type, size, fetched_at) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                [
+                    (self._manifest_path(path), sha256, None if key is None else str(key), owner, media_type, Path(path).stat().st_size, fetched_at)
+                    for sha256, path in entries
+                ],
+            )
+
+    def download(self, key, out_dir, fetch, owner=None, media_type=None):
+        """Link `key`'s stored files into `out_dir`, or run `fetch()` (-> Path or list of Paths) and store them.
+
+        Returns (paths, fetched).
+        """
+        stored = self.lookup(key) if key is not None else None
+        if stored:
+            entries = [(blob.stem, self._place(blob, Path(out_dir) / name)) for blob, name in stored]
+            self._record(key, entries, owner, media_type, replace_media=False)
+            return [path for _, path in entries], False
+        result = fetch()
+        paths = [Path(p) for p in (result if isinstance(result, (list, tuple)) else [result]) if p]
+        if paths:
+            self._record(key, [(self.ingest(p), p) for p in paths], owner, media_type)
+        return paths, True
+
+    def downloads_of(self, owner, limit=None):
+        """Manifest rows for files of `owner`, newest first: (path, pk, media_type, size, fetched_at)."""
+        with self._lock:
+            return self._db.execute(
+                "SELECT path, pk, media_type, size, fetched_at FROM manifest WHERE owner = ? COLLATE NOCASE "
+                "ORDER BY fetched_at DESC LIMIT ?",
+                (owner, -1 if limit is None else limit),
+            ).fetchall()
+
+    def _quarantine(self, sha256, ext):
+        """Forget a blob and move its file aside; linked files under downloads/ are left as they are.
+
+        Returns how many files the manifest had for it. Hardlinks share the
+        blob's inode, so a "corrupt" blob is often just a file the user edited.
+        """
+        with self._lock, self._db:
+            files = self._db.execute("SELECT COUNT(*) FROM manifest WHERE sha256 = ?", (sha256,)).fetchone()[0]
+            for table in ("media", "manifest", "blobs"):
+                self._db.execute(f"DELETE FROM {table} WHERE sha256 = ?", (sha256,))
+        blob = self._blob_path(sha256, ext)
+        if blob.exists():
+            (self.root / "quarantine").mkdir(exist_ok=True)
+            os.replace(blob, self.root / "quarantine" / blob.name)
+        return files
+
+    def verify(self, batch=BLOB_VERIFY_BATCH):
+        """Re-hash the least recently verified blobs; corrupt or missing ones are quarantined. Returns (checked, dropped)."""
+        with self._lock:
+            rows = self._db.execute("SELECT sha256, ext FROM blobs ORDER BY verified_at LIMIT ?", (batch,)).fetchall()
+        dropped = 0
+        for sha256, ext in rows:
+            blob = self._blob_path(sha256, ext)
+            try:
+                intact = _file_digest(blob) == sha256
+            except FileNotFoundError:
+                intact = False
+            if intact:
+                with self._lock:
+                    self._db.execute("UPDATE blobs SET verified_at = ? WHERE sha256 = ?", (time.time(), sha256))
+                    self._db.commit()
+            else:
+                files = self._quarantine(sha256, ext)
+                dropped += 1
+                print(
+                    f"Blob {sha256[:12]} failed verification; moved it to {self.root / 'quarantine'} and dropped it "
+                    f"from the index ({files} file(s) in downloads/ left untouched). The next download of it fetches it again"
+                )
+        return len(rows), dropped
+
+    def _describe(self, path, folder):
+        """(pk, owner, media_type) from a `<type>/<account>_<ip>/<owner>/<owner>_<pk>.<ext>` path."""
+        parts = path.relative_to(folder).parts
+        media_type = parts[0] if len(parts) > 1 else None
+        match = re.match(r"(?P<owner>.+?)_(?P<pk>\d{6,})(?:_\d+)?$", path.stem)
+        if len(parts) >= 4:
+            owner = parts[2]
+        else:
+            owner = match.group("owner") if match else path.stem
+        return (match.group("pk") if match else None), owner, media_type
+
+    def rebuild(self, folder=Path("downloads")):
+        """Re-index every file under `folder`, moving files downloaded before the store
+        existed into it (duplicates become links) and dropping manifest rows for files
+        that are gone. Returns (files indexed, bytes freed by deduplication).
+        """
+        folder = Path(folder)
+        with self._lock:
+            known = dict(self._db.execute("SELECT path, sha256 FROM manifest"))
+        files = saved = 0
+        by_pk = {}
+        seen = set()
+        for path in sorted(folder.rglob("*")):
+            if path.is_symlink() or not path.is_file() or path.suffix in (".part", ".link") or self._in_store(path):
+                continue
+            stat = path.stat()
+            sha256 = known.get(self._manifest_path(path)) if stat.st_nlink > 1 else None
+            if sha256 is None:
+                with self._lock:
+                    before = self._db.execute("SELECT COUNT(*) FROM blobs").fetchone()[0]
+                sha256 = self.ingest(path)
+                with self._lock:
+                    after = self._db.execute("SELECT COUNT(*) FROM blobs").fetchone()[0]
+                saved += stat.st_size if after == before else 0
+            pk, owner, media_type = self._describe(path, folder)
+            self._record(pk, [(sha256, path)], owner, media_type, fetched_at=stat.st_mtime, replace_media=False)
+            if pk:
+                # The same media under several account folders is one set of files
+                by_pk.setdefault(pk, {}).setdefault(path.name, (sha256, path))
+            seen.add(self._manifest_path(path))
+            files += 1
+        for pk, entries in by_pk.items():
+            if self.lookup(pk) is None:
+                with self._lock, self._db:
+                    self._db.executemany(
+                        "INSERT OR REPLACE INTO media (key, position, sha256, name) VALUES (?, ?, ?, ?)",
+                        [(pk, i, sha256, name) for i, (name, (sha256, _)) in enumerate(sorted(entries.items()))],
+                    )
+        # Also drops rows spelled differently from _manifest_path() and rows for the store's own files
+        scanned = Path(os.path.abspath(folder))
+        gone = [
+            (path,) for path in known
+            if path != self._manifest_path(path) or self._in_store(path)
+            or (path not in seen and Path(os.path.abspath(path)).is_relative_to(scanned))
+        ]
+        with self._lock, self._db:
+            self._db.executemany("DELETE FROM manifest WHERE path = ?", gone)
+        return files, saved
+
+    def start_verifier(self, period=BLOB_VERIFY_PERIOD):
+        """Verify blobs in a background daemon thread, one batch every `period` seconds.
+
+        An empty manifest (first run, or a deleted index) is rebuilt from downloads/ first.
+        """
+        if self._verifier is not None:
+            return
+
+        def loop():
+            try:
+                with self._lock:
+                    empty = self._db.execute("SELECT COUNT(*) FROM manifest").fetchone()[0] == 0
+                if empty:
+                    files, _ = self.rebuild()
+                    print(f"Download manifest rebuilt: {files} files indexed")
+            except Exception as e:
+                print(f"Download manifest rebuild failed: {e}")
+            while not shutdown_event.wait(period):
+                try:
+                    self.verify()
+                except Exception as e:
+                    print(f"Blob verification failed: {e}")
+
+        self._verifier = threading.Thread(target=loop, name="blob-verifier", daemon=True)
+        self._verifier.start()
+
+_blob_store = None
+
+def blob_store():
+    global _blob_store
+    if _blob_store is None:
+        _blob_store = BlobStore()
+    return _blob_store
+
+def download_from_url(api_client, url, result=None):
+    """Download story, reel, or post from Instagram URL
+
+    When a `result` dict is passed, the outcome (kind, folder, files, bytes,
+    fetched or error) is stored in it instead of being printed, and the media
+    is fetched on the calling thread: download_bulk sizes its own pool.
+    """
+    quiet = result is not None
+    result = {} if result is None else result
+    try:
+        if not quiet:
+            print(f"Processing URL: {url}")
         
         # Determine content type from URL
         if "/stories/" in url or "/s/" in url:
@@ -245,144 +1854,491 @@ def download_from_url(api_client, url):
         else:
             content_type = "posts"
         
-        # Extract media ID from URL
-        media_pk = api_client.media_pk_from_url(url)
-        media_id = api_client.media_id(media_pk)
-        
-        # Get media info to determine user
-        media_info = api_client.media_info(media_id)
-        username_from_media = getattr(media_info.user, "username", "unknown")
+        # Resolve media ID and owner (cached per shortcode)
+        media = resolve_media(api_client, url, need_owner=True)
+        media_id = media["media_id"]
+        username_from_media = media["owner_username"] or "unknown"
         
         # Create download directory
         out_dir = get_user_download_path(content_type, username_from_media)
         out_dir.mkdir(parents=True, exist_ok=True)
         
-        # Download based on content type
-        if content_type == "stories":
-            api_client.story_download(media_id, folder=str(out_dir))
-            print(f"✓ Story downloaded to: {out_dir}")
-        elif content_type == "reels":
-            api_client.clip_download(media_id, folder=str(out_dir))
-            print(f"✓ Reel downloaded to: {out_dir}")
+        # Download with the call that fits the media type (stories have their own endpoint)
+        def fetch():
+            if content_type == "stories":
+                paths, fetched = blob_store().download(
+                    media["pk"], out_dir, lambda: api_client.story_download(media_id, folder=str(out_dir)),
+                    owner=username_from_media, media_type=content_type,
+                )
+                kind, avoided = ("Story" if fetched else "Already stored; linked"), 0
+            else:
+                kind, paths, fetched, avoided = download_media(api_client, media, out_dir, username_from_media, content_type)
+            result.update(
+                files=[str(p) for p in paths], bytes=sum(p.stat().st_size for p in paths), fetched=fetched, avoided_calls=avoided
+            )
+            return kind
+
+        if quiet:
+            kind = fetch()
         else:
-            # Try photo first, then video, then album
-            try:
-                api_client.photo_download(media_id, folder=str(out_dir))
-                print(f"✓ Photo downloaded to: {out_dir}")
-            except Exception as photo_error:
-                try:
-                    api_client.video_download(media_id, folder=str(out_dir))
-                    print(f"✓ Video downloaded to: {out_dir}")
-                except Exception as video_error:
-                    try:
-                        api_client.album_download(media_id, folder=str(out_dir))
-                        print(f"✓ Album downloaded to: {out_dir}")
-                    except Exception as album_error:
-                        print(f"✗ Failed to download as photo ({photo_error}), video ({video_error}), or album ({album_error})")
-                        return False
-        
+            summary = download_many([(url, fetch)])
+            if not summary["ok"]:
+                return False
+            kind = summary["ok"][0][1]
+        result.update(kind=kind, folder=str(out_dir))
+        if not quiet:
+            skipped = f" (skipped {result['avoided_calls']} API calls)" if result.get("avoided_calls") else ""
+            print(f"✓ {kind} downloaded to: {out_dir}{skipped}")
         return True
     except Exception as e:
-        print(f"✗ Download failed: {e}")
+        result["error"] = str(e)
+        if not quiet:
+            print(f"✗ Download failed: {e}")
         return False
 
-def process_queue_file(path):
+BULK_RESULTS_PATH = "download_results.jsonl"
+
+def _read_url_list(source):
+    """URLs from a file path, or stdin for "-", ignoring blanks and #-comments."""
+    lines = sys.stdin if source == "-" else open(source, encoding="utf-8")
+    with lines:
+        return [line.strip() for line in lines if line.strip() and not line.lstrip().startswith("#")]
+
+def _completed_keys(results_path):
+    """Media keys already downloaded according to an earlier results file."""
+    done = set()
     try:
-        with open(path, "r", encoding="utf-8") as f:
-            usernames = [line.strip() for line in f if line.strip()]
+        with open(results_path, encoding="utf-8") as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    continue  # torn last line from an interrupted run
+                if entry.get("ok"):
+                    done.add(entry["key"])
     except FileNotFoundError:
-        return []
-    # Clear file after reading
-    try:
-        open(path, "w").close()
-    except Exception:
         pass
-    return usernames
+    return done
+
+def download_bulk(api_client, urls, results_path=BULK_RESULTS_PATH, workers=DOWNLOAD_WORKERS):
+    """Download many URLs in one session on a bounded pool, appending one JSON line per URL.
+
+    URLs are deduplicated by shortcode (story pk for stories) and URLs that
+    succeeded in an earlier run with the same results file are skipped, so an
+    interrupted archive resumes where it stopped. The workers share the
+    session's client: its metadata requests go out one at a time
+    (serialize_client_requests) and only the media transfers run `workers`
+    wide. Returns (ok, failed).
+    """
+    pending = {}
+    for url in urls:
+        pending.setdefault(_media_cache_key(url), url)
+    duplicates = len(urls) - len(pending)
+    done = _completed_keys(results_path)
+    jobs = [(key, url) for key, url in pending.items() if key not in done]
+    print(
+        f"{len(urls)} URLs: {duplicates} duplicates, {len(pending) - len(jobs)} already done in {results_path}, "
+        f"{len(jobs)} to download with {workers} workers"
+    )
+    ok = failed = fetched_bytes = 0
+    started = time.time()
+    write_lock = threading.Lock()
+
+    def job(key, url):
+        result = {}
+        job_started = time.time()
+        success = download_from_url(api_client, url, result)
+        entry = {"url": url, "key": key, "ok": success, "seconds": round(time.time() - job_started, 2), **result}
+        with write_lock, open(results_path, "a", encoding="utf-8") as f:
+            f.write(json.dumps(entry) + "\n")
+        return entry
+
+    pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="bulk")
+    try:
+        futures = [pool.submit(job, key, url) for key, url in jobs]
+        for n, future in enumerate(as_completed(futures), 1):
+            entry = future.result()
+            if entry["ok"]:
+                ok += 1
+                fetched_bytes += entry.get("bytes", 0) if entry.get("fetched") else 0
+            else:
+                failed += 1
+            elapsed = max(time.time() - started, 1e-6)
+            mark = f"✓ {entry.get('kind')}" if entry["ok"] else f"✗ {entry.get('error')}"
+            print(
+                f"[{n}/{len(jobs)}] {mark}: {entry['url']} "
+                f"({n / elapsed:.1f} URLs/s, {fetched_bytes / elapsed / 1e6:.1f} MB/s)"
+            )
+    except KeyboardInterrupt:
+        print("\nInterrupted; finishing downloads in progress. Run the same command again to resume.")
+    finally:
+        pool.shutdown(wait=True, cancel_futures=True)
+    elapsed = time.time() - started
+    print(f"Bulk download: {ok} ok, {failed} failed in {elapsed:.1f}s; results in {results_path}")
+    return ok, failed
+
+QUEUE_DB_PATH = "jobs.sqlite3"
+QUEUE_INGEST_BATCH = 1000  # lines per ingest transaction
+QUEUE_DRAIN_LIMIT = 500  # items per drain, so one huge queue cannot starve the inbox
+
+class JobQueue:
+    """Durable job queue in SQLite (WAL), fed from a legacy `<name>_queue.txt` file.
+
+    The text file is claimed by renaming it to `.ingesting` (so new appends land
+    in a fresh file) and copied into the queue in batches, with the byte offset
+    committed in the same transaction; a crash resumes from that offset. The
+    offset is tied to the spool file's identity (device, inode, mtime), so a
+    row left behind by a crash can never apply to a later spool file. Items
+    are consumed in bounded batches and acknowledged one at a time, so a crash
+    mid-drain loses nothing that was not processed yet.
+    """
+
+    def __init__(self, db_path, name, source_file=None):
+        self.name = name
+        self.source_file = Path(source_file) if source_file else None
+        self._lock = threading.Lock()
+        # Smooth weighted round-robin state, kept across distribute() calls
+        self._rr_current = {}
+        self._db = sqlite3.connect(str(db_path), check_same_thread=False, timeout=30)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS jobs ("
+            "id INTEGER PRIMARY KEY AUTOINCREMENT, queue TEXT NOT NULL, payload TEXT NOT NULL, created_at REAL NOT NULL)"
+        )
+        self._db.execute("CREATE INDEX IF NOT EXISTS jobs_queue_id ON jobs (queue, id)")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS ingest_offsets (queue TEXT PRIMARY KEY, offset INTEGER NOT NULL, file_id TEXT)"
+        )
+        self._db.commit()
+
+    def push_many(self, payloads):
+        now = time.time()
+        with self._lock:
+            self._db.executemany(
+                "INSERT INTO jobs (queue, payload, created_at) VALUES (?, ?, ?)",
+                [(self.name, payload, now) for payload in payloads],
+            )
+            self._db.commit()
+
+    def pending(self):
+        with self._lock:
+            return self._db.execute("SELECT COUNT(*) FROM jobs WHERE queue = ?", (self.name,)).fetchone()[0]
+
+    def peek(self, limit):
+        """Payloads of the next `limit` pending items, oldest first, without claiming them."""
+        with self._lock:
+            rows = self._db.execute(
+                "SELECT payload FROM jobs WHERE queue = ? ORDER BY id LIMIT ?", (self.name, limit)
+            ).fetchall()
+        return [payload for (payload,) in rows]
+
+    def ingest(self):
+        """Move lines from the text file into the queue; returns how many were added."""
+        if self.source_file is None:
+            return 0
+        spool = self.source_file.with_name(self.source_file.name + ".ingesting")
+        if not spool.exists():
+            try:
+                if self.source_file.stat().st_size == 0:
+                    return 0
+                os.replace(self.source_file, spool)
+            except FileNotFoundError:
+                return 0
+        stat = spool.stat()
+        file_id = f"{stat.st_dev}:{stat.st_ino}:{stat.st_mtime_ns}"
+        with self._lock:
+            row = self._db.execute("SELECT offset, file_id FROM ingest_offsets WHERE queue = ?", (self.name,)).fetchone()
+        # An offset recorded for another file (e.g. left by a crash after the unlink) does not apply
+        offset = row[0] if row and row[1] == file_id else 0
+        added = 0
+        with open(spool, "rb") as f:
+            f.seek(offset)
+            while True:
+                batch = []
+                for raw in f:
+                    line = raw.decode("utf-8", "replace").strip()
+                    if line:
+                        batch.append(line)
+                    if len(batch) >= QUEUE_INGEST_BATCH:
+                        break
+                offset = f.tell()
+                now = time.time()
+                with self._lock:
+                    self._db.executemany(
+                        "INSERT INTO jobs (queue, payload, created_at) VALUES (?, ?, ?)",
+                        [(self.name, payload, now) for payload in batch],
+                    )
+                    self._db.execute(
+                        "INSERT OR REPLACE INTO ingest_offsets (queue, offset, file_id) VALUES (?, ?, ?)",
+                        (self.name, offset, file_id),
+                    )
+                    self._db.commit()
+                added += len(batch)
+                if len(batch) < QUEUE_INGEST_BATCH:
+                    break
+        os.remove(spool)
+        with self._lock:
+            self._db.execute("DELETE FROM ingest_offsets WHERE queue = ?", (self.name,))
+            self._db.commit()
+        return added
+
+    def drain(self, handler, batch_size=100, max_items=QUEUE_DRAIN_LIMIT):
+        """Ingest, then run `handler(payload)` per item and ack each one; returns items processed."""
+        try:
+            self.ingest()
+        except Exception as e:
+            print(f"Warning: failed to ingest {self.source_file}: {e}")
+        processed = 0
+        last_id = 0
+        while max_items is None or processed < max_items:
+            limit = batch_size if max_items is None else min(batch_size, max_items - processed)
+            with self._lock:
+                rows = self._db.execute(
+                    "SELECT id, payload FROM jobs WHERE queue = ? AND id > ? ORDER BY id LIMIT ?",
+                    (self.name, last_id, limit),
+                ).fetchall()
+            if not rows:
+                break
+            for job_id, payload in rows:
+                if shutdown_event.is_set():
+                    return processed
+                try:
+                    handler(payload)
+                except RateLimitExceeded as e:
+                    # Leave the item queued; it is retried on a later cadence
+                    print(f"{self.name} queue paused: {e}")
+                    return processed
+                with self._lock:
+                    self._db.execute("DELETE FROM jobs WHERE id = ?", (job_id,))
+                    self._db.commit()
+                last_id = job_id
+                processed += 1
+        return processed
+
+    def distribute(self, shares, batch_size=1000):
+        """Move pending items into other queues in proportion to `shares` ({queue name: weight}).
+
+        The round-robin position carries over between calls, so a trickle of
+        small batches is still spread by weight instead of always landing on
+        the heaviest queue.
+        """
+        shares = {name: weight for name, weight in shares.items() if weight > 0}
+        if not shares:
+            return 0
+        total = sum(shares.values())
+        current = {name: self._rr_current.get(name, 0.0) for name in shares}
+        self._rr_current = current
+        moved = 0
+        while True:
+            with self._lock:
+                rows = self._db.execute(
+                    "SELECT id FROM jobs WHERE queue = ? ORDER BY id LIMIT ?", (self.name, batch_size)
+                ).fetchall()
+                if not rows:
+                    return moved
+                updates = []
+                for (job_id,) in rows:
+                    # Smooth weighted round-robin
+                    for name in current:
+                        current[name] += shares[name]
+                    target = max(current, key=current.get)
+                    current[target] -= total
+                    updates.append((target, job_id))
+                self._db.executemany("UPDATE jobs SET queue = ? WHERE id = ?", updates)
+                self._db.commit()
+            moved += len(rows)
+
+    def reclaim(self, from_queue):
+        """Move every item of `from_queue` back into this queue; returns how many moved."""
+        with self._lock:
+            cursor = self._db.execute("UPDATE jobs SET queue = ? WHERE queue = ?", (self.name, from_queue))
+            self._db.commit()
+            return cursor.rowcount
+
+# Queues any farm worker can process; unfollow/post act on one specific account
+SHARDED_QUEUES = ("follow", "like", "comment", "download")
+# Set in farm workers: sharded queues are read from `<name>@<account>` instead of the text files
+QUEUE_SHARD = None
+_job_queues = {}
+
+def job_queue(name):
+    """Queue `name`, ingesting from `<name>_queue.txt` (or this worker's shard of it)."""
+    if name not in _job_queues:
+        if QUEUE_SHARD and name in SHARDED_QUEUES:
+            _job_queues[name] = JobQueue(QUEUE_DB_PATH, f"{name}@{QUEUE_SHARD}")
+        else:
+            _job_queues[name] = JobQueue(QUEUE_DB_PATH, name, f"{name}_queue.txt")
+    return _job_queues[name]
 
 def process_follow_queue(api_client):
-    usernames = process_queue_file("follow_queue.txt")
-    for uname in usernames:
+    def follow(uname):
         try:
             user_id = get_user_id_from_username(api_client, uname)
-            api_client.user_follow(user_id)
+            with rate_governor.action("follow"):
+                api_client.user_follow(user_id)
             print(f"Followed: {uname}")
+        except RateLimitExceeded:
+            raise
         except Exception as e:
             print(f"Follow failed for {uname}: {e}")
+    job_queue("follow").drain(follow)
 
 def process_unfollow_queue(api_client):
-    usernames = process_queue_file("unfollow_queue.txt")
-    for uname in usernames:
+    def unfollow(uname):
         try:
             user_id = get_user_id_from_username(api_client, uname)
-            api_client.user_unfollow(user_id)
+            with rate_governor.action("unfollow"):
+                api_client.user_unfollow(user_id)
             print(f"Unfollowed: {uname}")
+        except RateLimitExceeded:
+            raise
         except Exception as e:
             print(f"Unfollow failed for {uname}: {e}")
+    job_queue("unfollow").drain(unfollow)
 
 def process_like_queue(api_client):
-    urls = process_queue_file("like_queue.txt")
-    for url in urls:
+    def like(url):
         try:
-            media_pk = api_client.media_pk_from_url(url)
-            media_id = api_client.media_id(media_pk)
-            api_client.media_like(media_id)
+            media_id = resolve_media(api_client, url)["media_id"]
+            with rate_governor.action("like"):
+                api_client.media_like(media_id)
             print(f"Liked: {url}")
+        except RateLimitExceeded:
+            raise
         except Exception as e:
             print(f"Like failed for {url}: {e}")
+    job_queue("like").drain(like)
 
 def process_comment_queue(api_client):
     # Each line: <url>|<comment text>
-    try:
-        with open("comment_queue.txt", "r", encoding="utf-8") as f:
-            lines = [line.strip() for line in f if line.strip()]
-        open("comment_queue.txt", "w").close()
-    except FileNotFoundError:
-        lines = []
-    for line in lines:
+    def comment(line):
         try:
             if "|" not in line:
                 print(f"Skip invalid comment line: {line}")
-                continue
+                return
             url, text = line.split("|", 1)
-            media_pk = api_client.media_pk_from_url(url)
-            media_id = api_client.media_id(media_pk)
-            api_client.media_comment(media_id, text)
+            media_id = resolve_media(api_client, url)["media_id"]
+            with rate_governor.action("comment"):
+                api_client.media_comment(media_id, text)
             print(f"Commented on {url}: {text}")
+        except RateLimitExceeded:
+            raise
         except Exception as e:
             print(f"Comment failed for line '{line}': {e}")
+    job_queue("comment").drain(comment)
+
+UPLOAD_CACHE_DIR = Path("prepared_uploads")
+UPLOAD_PREP_WORKERS = max(1, int(os.environ.get("UPLOAD_PREP_WORKERS", "2")))
+UPLOAD_PREP_AHEAD = 4  # queued posts prepared ahead of the uploader
+UPLOAD_PREP_VERSION = 1  # bump when preparation output changes to invalidate the cache
+
+def _parse_post_line(line):
+    """`<path>|<caption>|<type>` -> (path, caption, type); type defaults to photo."""
+    parts = line.split("|")
+    path = parts[0]
+    caption = parts[1] if len(parts) > 1 else ""
+    post_type = parts[2].lower() if len(parts) > 2 else "photo"
+    return path, caption, post_type
+
+def prepare_upload(path, post_type):
+    """Validate and pre-process one upload; runs in the preparation process pool.
+
+    Photos are only checked to be readable images: photo_upload always runs its
+    own crop/resize/JPEG encode, so doing it here too would encode twice. Videos
+    get their cover thumbnail extracted, cached under UPLOAD_CACHE_DIR by
+    content hash so retries reuse it.
+    Returns {"path", "thumbnail", "seconds", "cached"}.
+    """
+    started = time.perf_counter()
+    if post_type == "photo":
+        from PIL import Image
+
+        with Image.open(path) as im:
+            im.verify()
+        return {"path": str(path), "thumbnail": None, "seconds": time.perf_counter() - started, "cached": False}
+    key = hashlib.sha256(f"{_file_digest(path)}:{post_type}:{UPLOAD_PREP_VERSION}".encode()).hexdigest()[:32]
+    entry_dir = UPLOAD_CACHE_DIR / key
+    manifest = entry_dir / "prepared.json"
+    try:
+        prepared = json.loads(manifest.read_text(encoding="utf-8"))
+        if all(Path(p).exists() for p in (prepared["path"], prepared["thumbnail"]) if p):
+            return {**prepared, "seconds": time.perf_counter() - started, "cached": True}
+    except (FileNotFoundError, ValueError, KeyError):
+        pass
+
+    entry_dir.mkdir(parents=True, exist_ok=True)
+    from instagrapi.mixins.clip import crop_thumbnail
+    from instagrapi.utils.video import generate_video_thumbnail
+
+    prepared = {"path": str(path), "thumbnail": str(entry_dir / "thumbnail.jpg")}
+    # Reels get the same center crop clip_upload applies to generated thumbnails
+    generate_video_thumbnail(Path(path), Path(prepared["thumbnail"]), crop_thumbnail=crop_thumbnail if post_type == "reel" else None)
+    # The manifest is written last, so a crash mid-preparation is simply redone
+    tmp_path = manifest.with_name(manifest.name + ".tmp")
+    tmp_path.write_text(json.dumps(prepared), encoding="utf-8")
+    os.replace(tmp_path, manifest)
+    return {**prepared, "seconds": time.perf_counter() - started, "cached": False}
+
+_prep_pool = None
+
+def _upload_prep_pool():
+    global _prep_pool
+    if _prep_pool is None:
+        # spawn, not fork: the bot process has live threads and sockets
+        _prep_pool = ProcessPoolExecutor(max_workers=UPLOAD_PREP_WORKERS, mp_context=multiprocessing.get_context("spawn"))
+    return _prep_pool
 
 def process_post_queue(api_client):
     # Each line: <path>|<caption>|<type>
     # type: photo | reel | video (default photo if missing)
-    try:
-        with open("post_queue.txt", "r", encoding="utf-8") as f:
-            lines = [line.strip() for line in f if line.strip()]
-        open("post_queue.txt", "w").close()
-    except FileNotFoundError:
-        lines = []
-    for line in lines:
+    uploaders = {"photo": api_client.photo_upload, "reel": api_client.clip_upload, "video": api_client.video_upload}
+    queue = job_queue("post")
+    pool = _upload_prep_pool()
+    preparing = {}  # line -> future; the next few posts are prepared while the current one uploads
+    timings = {"posted": 0, "prepare": 0.0, "cached": 0, "stalled": 0.0, "upload": 0.0}
+
+    def prepare_ahead():
+        for line in queue.peek(UPLOAD_PREP_AHEAD + 1):
+            path, _, post_type = _parse_post_line(line)
+            if line not in preparing and post_type in uploaders:
+                preparing[line] = pool.submit(prepare_upload, path, post_type)
+
+    def post(line):
         try:
-            parts = line.split("|")
-            if len(parts) < 1:
-                continue
-            path = parts[0]
-            caption = parts[1] if len(parts) > 1 else ""
-            post_type = parts[2].lower() if len(parts) > 2 else "photo"
-            if post_type == "photo":
-                api_client.photo_upload(path, caption)
-                print(f"Posted photo: {path}")
-            elif post_type == "reel":
-                # Reels
-                api_client.clip_upload(path, caption)
-                print(f"Posted reel: {path}")
-            elif post_type == "video":
-                api_client.video_upload(path, caption)
-                print(f"Posted video: {path}")
-            else:
+            path, caption, post_type = _parse_post_line(line)
+            if post_type not in uploaders:
                 print(f"Unknown post type '{post_type}' for line: {line}")
+                return
+            prepare_ahead()
+            future = preparing.pop(line, None) or pool.submit(prepare_upload, path, post_type)
+            waited = time.perf_counter()
+            prepared = future.result()
+            timings["stalled"] += time.perf_counter() - waited
+            timings["prepare"] += prepared["seconds"]
+            timings["cached"] += prepared["cached"]
+            extra = {} if post_type == "photo" else {"thumbnail": Path(prepared["thumbnail"])}
+            with rate_governor.action("upload"):
+                started = time.perf_counter()
+                uploaders[post_type](Path(prepared["path"]), caption, **extra)
+                timings["upload"] += time.perf_counter() - started
+            timings["posted"] += 1
+            print(f"Posted {post_type}: {path}")
+        except RateLimitExceeded:
+            raise
         except Exception as e:
             print(f"Post failed for line '{line}': {e}")
 
+    if queue.drain(post):
+        print(
+            f"Post queue: {timings['posted']} posted; preparation {timings['prepare']:.1f}s "
+            f"({timings['cached']} cached), uploader waited on preparation {timings['stalled']:.1f}s, "
+            f"uploading {timings['upload']:.1f}s"
+        )
+
+def process_download_queue(api_client):
+    # Each line: an Instagram story/reel/post URL
+    job_queue("download").drain(lambda url: download_from_url(api_client, url))
+
 def like_latest_reel(api_client, username):
     try:
         uname = username.lstrip("@")
@@ -390,24 +2346,15 @@ def like_latest_reel(api_client, username):
         if not user_id:
             print(f"Could not resolve user: @{uname}")
             return
-        medias = []
-        # Try user_clips first
         try:
-            medias = api_client.user_clips(user_id, amount=18) or []
+            latest = latest_media.latest(api_client, user_id, "reels")
         except Exception:
-            medias = []
-        # Fallback: filter from user_medias
-        if not medias:
-            try:
-                all_medias = api_client.user_medias(user_id, amount=24) or []
-                medias = [m for m in all_medias if str(getattr(m, "product_type", "")).lower() in ("clips", "reel", "clips_together")]
-            except Exception:
-                medias = []
-        if not medias:
+            latest = None
+        if latest is None:
             print(f"No reels available (private account or none posted) for @{uname}")
             return
-        latest = sorted(medias, key=lambda m: getattr(m, "taken_at", None) or 0, reverse=True)[0]
-        api_client.media_like(latest.id)
+        with rate_governor.action("like"):
+            api_client.media_like(latest.id)
         print(f"Liked latest reel of @{uname}")
     except Exception as e:
         print(f"Like latest reel failed for @{username}: {e}")
@@ -419,204 +2366,397 @@ def like_latest_post(api_client, username):
         if not user_id:
             print(f"Could not resolve user: @{uname}")
             return
-        medias = []
         try:
-            medias = api_client.user_medias(user_id, amount=30) or []
+            latest = latest_media.latest(api_client, user_id, "posts")
         except Exception:
-            medias = []
-        # Exclude reels/igtv
-        medias = [m for m in medias if str(getattr(m, "product_type", "")).lower() not in ("clips", "igtv")]
-        if not medias:
+            latest = None
+        if latest is None:
             print(f"No standard posts available (private account or none posted) for @{uname}")
             return
-        latest = sorted(medias, key=lambda m: getattr(m, "taken_at", None) or 0, reverse=True)[0]
-        api_client.media_like(latest.id)
+        with rate_governor.action("like"):
+            api_client.media_like(latest.id)
         print(f"Liked latest post of @{uname}")
     except Exception as e:
         print(f"Like latest post failed for @{username}: {e}")
 
-def try_parse_and_execute_commands(api_client, text):
-    global PRINT_DMS, RESOLVE_USERNAMES
-    if not text:
-        return False
-    t = text.strip()
-    m = re.search(r"like\s+(?:the\s+)?latest\s+reel\s+of\s+@([A-Za-z0-9._]+)", t, flags=re.IGNORECASE)
-    if m:
-        like_latest_reel(api_client, m.group(1))
-        return True
-    m = re.search(r"like\s+(?:the\s+)?latest\s+post\s+of\s+@([A-Za-z0-9._]+)", t, flags=re.IGNORECASE)
-    if m:
-        like_latest_post(api_client, m.group(1))
-        return True
-    m = re.search(r"^follow\s+@([A-Za-z0-9._]+)$", t, flags=re.IGNORECASE)
-    if m:
-        uname = m.group(1)
-        try:
-            user_id = api_client.user_id_from_username(uname)
-            api_client.user_follow(user_id)
-            print(f"Followed: {uname}")
-        except Exception as e:
-            print(f"Follow failed for {uname}: {e}")
-        return True
-    m = re.search(r"^unfollow\s+@([A-Za-z0-9._]+)$", t, flags=re.IGNORECASE)
-    if m:
-        uname = m.group(1)
-        try:
-            user_id = api_client.user_id_from_username(uname)
-            api_client.user_unfollow(user_id)
-            print(f"Unfollowed: {uname}")
-        except Exception as e:
-            print(f"Unfollow failed for {uname}: {e}")
-        return True
-    m = re.search(r"(?:write|send)\s+(.+?)\s+to\s+@([A-Za-z0-9._]+)$", t, flags=re.IGNORECASE)
-    if m:
-        dm_text = m.group(1).strip()
-        uname = m.group(2).strip()
-        send_dm_to_username(api_client, uname, dm_text)
-        return True
-    m = re.search(r"download\s+(?:story|stories)\s+of\s+@([A-Za-z0-9._]+)$", t, flags=re.IGNORECASE)
-    if m:
-        download_stories_of_username(api_client, m.group(1))
-        return True
-    m = re.search(r"download\s+(?:latest\s+)?reel\s+of\s+@([A-Za-z0-9._]+)$", t, flags=re.IGNORECASE)
-    if m:
-        download_latest_reel_of_username(api_client, m.group(1))
-        return True
-    m = re.search(r"download\s+(?:latest\s+)?post\s+of\s+@([A-Za-z0-9._]+)$", t, flags=re.IGNORECASE)
-    if m:
-        download_latest_post_of_username(api_client, m.group(1))
-        return True
-    m = re.search(r"status\s+of\s+@([A-Za-z0-9._]+)$", t, flags=re.IGNORECASE)
-    if m:
-        print_user_status(api_client, m.group(1))
-        return True
-    m = re.search(r"^show\s+dms?(?:\s+(\d+))?$", t, flags=re.IGNORECASE)
-    if m:
-        count = int(m.group(1)) if m.group(1) else 5
-        show_recent_dms(api_client, max(1, min(count, 20)))
-        return True
-    if t.lower() == "show live dms":
-        PRINT_DMS = True
-        print("Live DM printing enabled.")
-        return True
-    if t.lower() == "hide live dms":
-        PRINT_DMS = False
-        print("Live DM printing disabled.")
-        return True
-    if t.lower() == "resolve usernames on":
-        RESOLVE_USERNAMES = True
-        print("Username resolution enabled.")
-        return True
-    if t.lower() == "resolve usernames off":
-        RESOLVE_USERNAMES = False
-        print("Username resolution disabled.")
-        return True
-    
-    # Hashtag and location targeting
-    m = re.search(r"like\s+posts\s+from\s+hashtag\s+(\w+)\s+(\d+)?", t, flags=re.IGNORECASE)
-    if m:
-        hashtag = m.group(1)
-        amount = int(m.group(2)) if m.group(2) else 10
-        like_posts_from_hashtag(api_client, hashtag, amount)
-        return True
-        
-    m = re.search(r"follow\s+from\s+hashtag\s+(\w+)\s+(\d+)?", t, flags=re.IGNORECASE)
-    if m:
-        hashtag = m.group(1)
-        amount = int(m.group(2)) if m.group(2) else 10
-        follow_from_hashtag(api_client, hashtag, amount)
-        return True
-    
-    m = re.search(r"like\s+posts\s+from\s+location\s+(\w+)\s+(\d+)?", t, flags=re.IGNORECASE)
-    if m:
-        location = m.group(1)
-        amount = int(m.group(2)) if m.group(2) else 10
-        like_posts_from_location(api_client, location, amount)
+CRAWL_PAGE_SIZE = 27  # medias per hashtag/location page
+CRAWL_MAX_PAGES = 40  # stop paging a feed that keeps yielding nothing usable
+CRAWL_CONCURRENCY = 2  # actions in flight; the rate governor still paces each one
+
+def paginate(fetch_page, max_pages=CRAWL_MAX_PAGES):
+    """Yield items lazily from `fetch_page(cursor) -> (items, next_cursor)`, one page at a time."""
+    cursor = None
+    for _ in range(max_pages):
+        items, cursor = fetch_page(cursor)
+        yield from items
+        if not cursor:
+            return
+
+def unique_by(items, key, seen=None):
+    """Drop items whose key was already yielded (or is in `seen`)."""
+    seen = set() if seen is None else seen
+    for item in items:
+        k = key(item)
+        if k not in seen:
+            seen.add(k)
+            yield item
+
+def run_bounded(items, action, amount, concurrency=CRAWL_CONCURRENCY):
+    """Run `action(item) -> bool` over a lazy iterable until `amount` succeed.
+
+    At most `concurrency` actions are in flight, and a new item is only pulled
+    when succeeded + in-flight is below `amount`, so the source (and its
+    pagination) stops as soon as enough work is done. A RateLimitExceeded from
+    an action stops the run. Returns (succeeded, attempted).
+    """
+    items = iter(items)
+    done = attempted = 0
+    stop = None
+    with ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix="crawl") as pool:
+        inflight = set()
+        exhausted = False
+        while True:
+            while not exhausted and stop is None and len(inflight) < concurrency and done + len(inflight) < amount:
+                item = next(items, None)
+                if item is None:
+                    exhausted = True
+                    break
+                inflight.add(pool.submit(action, item))
+                attempted += 1
+            if not inflight:
+                break
+            finished = next(as_completed(inflight))
+            inflight.discard(finished)
+            try:
+                done += 1 if finished.result() else 0
+            except RateLimitExceeded as e:
+                stop = e
+            except Exception as e:
+                print(f"Crawl action failed: {e}")
+    if hasattr(items, "close"):
+        items.close()  # stop paginating
+    if stop is not None:
+        print(f"Stopped early: {stop}")
+    return done, attempted
+
+def hashtag_medias(api_client, hashtag, tab="recent"):
+    return paginate(lambda cursor: api_client.hashtag_medias_v1_chunk(hashtag, max_amount=CRAWL_PAGE_SIZE, tab_key=tab, max_id=cursor))
+
+def location_medias(api_client, location_pk, tab="recent"):
+    return paginate(lambda cursor: api_client.location_medias_v1_chunk(location_pk, max_amount=CRAWL_PAGE_SIZE, tab_key=tab, max_id=cursor))
+
+def _like_media(api_client, media):
+    try:
+        with rate_governor.action("like"):
+            api_client.media_like(media.id)
         return True
-    
-    # Add profile picture download command
-    m = re.search(r"download\s+profile\s+picture\s+of\s+@([A-Za-z0-9._]+)$", t, flags=re.IGNORECASE)
-    if m:
-        download_profile_picture(api_client, m.group(1))
+    except RateLimitExceeded:
+        raise
+    except Exception as e:
+        print(f"Like failed for {getattr(media, 'code', media.pk)}: {e}")
+        return False
+
+def _follow_user(api_client, user):
+    try:
+        with rate_governor.action("follow"):
+            api_client.user_follow(user.pk)
         return True
-    
-    return False
+    except RateLimitExceeded:
+        raise
+    except Exception as e:
+        print(f"Follow failed for {getattr(user, 'username', user.pk)}: {e}")
+        return False
+
+def _unliked(medias):
+    return unique_by((m for m in medias if not getattr(m, "has_liked", False)), lambda m: str(m.pk))
+
+def like_posts_from_hashtag(api_client, hashtag, amount=10):
+    tag = hashtag.lstrip("#")
+    try:
+        done, attempted = run_bounded(_unliked(hashtag_medias(api_client, tag)), lambda m: _like_media(api_client, m), amount)
+        print(f"Liked {done}/{amount} posts from #{tag} ({attempted} tried)")
+    except Exception as e:
+        print(f"Like posts from #{tag} failed: {e}")
+
+def follow_from_hashtag(api_client, hashtag, amount=10):
+    tag = hashtag.lstrip("#")
+    try:
+        owners = (m.user for m in hashtag_medias(api_client, tag) if getattr(m, "user", None))
+        # One follow per author, never ourselves
+        authors = unique_by(owners, lambda u: str(u.pk), {str(api_client.user_id)})
+        done, attempted = run_bounded(authors, lambda u: _follow_user(api_client, u), amount)
+        print(f"Followed {done}/{amount} authors from #{tag} ({attempted} tried)")
+    except Exception as e:
+        print(f"Follow from #{tag} failed: {e}")
+
+def like_posts_from_location(api_client, location, amount=10):
+    try:
+        places = api_client.location_search_name(location)
+        if not places:
+            print(f"No location found for '{location}'")
+            return
+        place = places[0]
+        done, attempted = run_bounded(_unliked(location_medias(api_client, place.pk)), lambda m: _like_media(api_client, m), amount)
+        print(f"Liked {done}/{amount} posts from {place.name} ({attempted} tried)")
+    except Exception as e:
+        print(f"Like posts from location '{location}' failed: {e}")
+
+def try_parse_and_execute_commands(api_client, text):
+    """Run the DM/terminal command in `text`, if it is one; returns whether it was handled."""
+    found = command_registry.match(text)
+    if found is None:
+        return False
+    cmd, args = found
+    cmd.handler(api_client, **args)
+    return True
+
+class Command:
+    def __init__(self, keywords, grammar, handler, usage):
+        self.keywords = tuple(k.lower() for k in keywords)
+        self.pattern = re.compile(grammar, flags=re.IGNORECASE)
+        self.handler = handler
+        self.usage = usage
+
+class CommandRegistry:
+    """Single-pass dispatcher for DM and terminal commands.
+
+    Commands are indexed by their first word, so text that does not start with
+    a known keyword is rejected with one dict lookup before any regex runs.
+    Each candidate then gets one precompiled full-match of its grammar, whose
+    named groups become the handler's keyword arguments.
+    """
+
+    def __init__(self, table):
+        self.commands = []
+        self.by_keyword = {}
+        for keywords, grammar, handler, usage in table:
+            cmd = Command(keywords, grammar, handler, usage)
+            self.commands.append(cmd)
+            for keyword in cmd.keywords:
+                self.by_keyword.setdefault(keyword, []).append(cmd)
+
+    def match(self, text):
+        """Return (command, kwargs) for `text`, or None if it is not a command."""
+        if not text:
+            return None
+        t = text.strip()
+        head = t.split(None, 1)[0].lower() if t else ""
+        for cmd in self.by_keyword.get(head, ()):
+            m = cmd.pattern.fullmatch(t)
+            if m:
+                return cmd, {k: v for k, v in m.groupdict().items() if v is not None}
+        return None
+
+    def help_lines(self):
+        return [cmd.usage for cmd in self.commands]
 
 def send_dm_to_username(api_client, username, message_text):
     try:
         uname = username.lstrip("@")
         user_id = get_user_id_from_username(api_client, uname)
-        api_client.direct_send(message_text, [user_id])
+        with rate_governor.action("dm"):
+            api_client.direct_send(message_text, [user_id])
         print(f"DM sent to {uname}: {message_text}")
     except Exception as e:
         print(f"DM failed to {username}: {e}")
 
-def _command_session_loop(api_client):
-    print("Command session started. Type commands or 'help'/'exit'.")
-    while True:
-        try:
-            line = input("> ").strip()
-        except (EOFError, KeyboardInterrupt):
-            print("\nCommand session closed.")
-            return
-        if not line:
-            continue
-        if line.lower() in ("exit", "quit"):
-            print("Exiting command session (bot continues running).")
-            return
-        if line.lower() in ("help", "h", "?"):
-            print(
-                "Commands: follow <username> | unfollow <username> | "
-                "like the latest reel of <username> | "
-                "write <message> to <username>"
-            )
-            continue
-        handled = try_parse_and_execute_commands(api_client, line)
-        if not handled:
-            print("Unknown command. Type 'help' for options.")
+def _story_download_job(api_client, story, uname, out_dir):
+    url = getattr(story, "thumbnail_url", None) if getattr(story, "media_type", None) == 1 else getattr(story, "video_url", None)
+    if url:
+        # The story object already carries its media URL; skip the extra story_info call
+        default_ext = ".jpg" if story.media_type == 1 else ".mp4"
+        dest = out_dir / f"{uname}_{story.pk}{_url_extension(url, default_ext)}"
+        return lambda: blob_store().download(story.pk, out_dir, lambda: fetch_media(url, dest), owner=uname, media_type="stories")
+    fetch = lambda: api_client.story_download(story.pk, folder=str(out_dir))
+    return lambda: blob_store().download(story.pk, out_dir, fetch, owner=uname, media_type="stories")
 
-def start_command_session(api_client):
-    t = threading.Thread(target=_command_session_loop, args=(api_client,), daemon=True)
-    t.start()
+def download_stories_of_username(api_client, username, only_new=False, verbose=True):
+    """Download the active stories of `username`; returns {"stories", "new", "ok", "failed"} or None on error.
 
-def download_stories_of_username(api_client, username):
+    `only_new` skips story ids already in the blob store instead of re-linking them.
+    """
     try:
         uname = username.lstrip("@")
         user_id = get_user_id_from_username(api_client, uname)
         stories = api_client.user_stories(user_id)
-        if not stories:
-            print(f"No active stories for {uname}")
-            return
+        fresh = [story for story in stories if not (only_new and blob_store().lookup(story.pk))]
+        if not fresh:
+            if verbose:
+                print(f"No {'new ' if only_new and stories else 'active '}stories for {uname}")
+            return {"stories": stories, "new": 0, "ok": 0, "failed": 0}
         out_dir = get_user_download_path("stories", uname)
         out_dir.mkdir(parents=True, exist_ok=True)
-        downloaded = 0
-        for story in stories:
-            try:
-                api_client.story_download(story.id, filename=str(out_dir))
-                downloaded += 1
-            except Exception as e:
-                print(f"Failed to download a story for {uname}: {e}")
-        print(f"Downloaded {downloaded} stories for {uname} into {out_dir}")
+        summary = download_many(
+            [(f"story {story.pk} of {uname}", _story_download_job(api_client, story, uname, out_dir)) for story in fresh]
+        )
+        print(f"Stories for {uname}: {format_download_summary(summary)} into {out_dir}")
+        return {"stories": stories, "new": len(fresh), "ok": len(summary["ok"]), "failed": len(summary["failed"])}
     except Exception as e:
         print(f"Download stories failed for {username}: {e}")
+        return None
+
+STORY_TTL = 24 * 3600
+STORY_WATCH_FILE = "watchlist.txt"
+STORY_WATCH_CHECKS_PER_HOUR = int(os.environ.get("STORY_WATCH_CHECKS_PER_HOUR", "120"))
+STORY_WATCH_MIN_INTERVAL = 15 * 60
+STORY_WATCH_MAX_INTERVAL = 8 * 3600  # well inside the 24 h story lifetime
+STORY_WATCH_DEFAULT_GAP = 12 * 3600  # assumed time between stories until we have seen some
+STORY_WATCH_TICK = 30  # seconds between watch-list passes in bot mode
+
+class StoryWatchList:
+    """Archive the stories of the accounts in `watchlist.txt` before they expire.
+
+    Each account has its own next-check time, kept in a heap so a pass only
+    touches accounts that are due. The interval follows the account's posting
+    rhythm (a moving average of the gap between its stories), is shortened when
+    a story failed to download and will expire soon, and never exceeds
+    STORY_WATCH_MAX_INTERVAL. Checks draw from a token bucket of
+    `checks_per_hour`, which spreads them evenly over the hour however many
+    accounts are due; the most overdue go first.
+    """
+
+    def __init__(self, state_path, list_path=STORY_WATCH_FILE, checks_per_hour=STORY_WATCH_CHECKS_PER_HOUR):
+        self.state_path = Path(state_path)
+        self.list_path = Path(list_path)
+        # A pass every STORY_WATCH_TICK may use at most one tick's share of the hourly budget
+        self.budget = _Budget(checks_per_hour, checks_per_hour * 24, max(1, round(checks_per_hour * STORY_WATCH_TICK / 3600)))
+        self.accounts = {}  # username -> {"next_check_at", "gap", "last_story_at", "checks", "archived"}
+        self._heap = []  # (next_check_at, username); stale entries are skipped
+        self._list_mtime = None
+        self._lock = threading.Lock()
+        try:
+            self.accounts = json.loads(self.state_path.read_text(encoding="utf-8"))
+        except FileNotFoundError:
+            pass
+        except Exception as e:
+            print(f"Warning: could not read {self.state_path} ({e}); story watch schedule reset")
+
+    def _schedule(self, uname, when):
+        self.accounts[uname]["next_check_at"] = when
+        heapq.heappush(self._heap, (when, uname))
+
+    def reload(self):
+        """Pick up edits to the watch-list file; new accounts are due right away."""
+        try:
+            mtime = self.list_path.stat().st_mtime
+        except FileNotFoundError:
+            mtime = None
+        if mtime == self._list_mtime and self._heap:
+            return
+        self._list_mtime = mtime
+        names = []
+        if mtime is not None:
+            for line in self.list_path.read_text(encoding="utf-8").splitlines():
+                line = line.strip().lstrip("@")
+                if line and not line.startswith("#"):
+                    names.append(line.lower())
+        with self._lock:
+            self.accounts = {
+                uname: self.accounts.get(uname)
+                or {"next_check_at": 0.0, "gap": STORY_WATCH_DEFAULT_GAP, "last_story_at": 0.0, "checks": 0, "archived": 0}
+                for uname in names
+            }
+            self._heap = [(state["next_check_at"], uname) for uname, state in self.accounts.items()]
+            heapq.heapify(self._heap)
+
+    def set_watched(self, uname, watched):
+        uname = uname.lstrip("@").lower()
+        try:
+            lines = self.list_path.read_text(encoding="utf-8").splitlines()
+        except FileNotFoundError:
+            lines = []
+        kept = [line for line in lines if line.strip().lstrip("@").lower() != uname]
+        if watched:
+            kept.append(uname)
+        self.list_path.write_text("\n".join(kept) + ("\n" if kept else ""), encoding="utf-8")
+        self.reload()
+
+    def _next_interval(self, state, result, now):
+        interval = min(STORY_WATCH_MAX_INTERVAL, max(STORY_WATCH_MIN_INTERVAL, state["gap"] / 2))
+        if result and result["failed"]:
+            # Retry missed stories while they still exist
+            expiring = [
+                _taken_at(story) + STORY_TTL for story in result["stories"] if not blob_store().lookup(story.pk)
+            ]
+            if expiring:
+                interval = min(interval, max(STORY_WATCH_MIN_INTERVAL, (min(expiring) - now) / 4))
+        return interval
+
+    def _check(self, api_client, uname):
+        with self._lock:
+            state = self.accounts.get(uname)
+        if state is None:
+            return False  # unwatched since it was popped
+        now = time.time()
+        result = download_stories_of_username(api_client, uname, only_new=True, verbose=False)
+        state["checks"] += 1
+        if result:
+            state["archived"] += result["ok"]
+            newest = max((_taken_at(story) for story in result["stories"]), default=0.0)
+            if newest > state["last_story_at"]:
+                if state["last_story_at"]:
+                    # Moving average of the gap between this account's stories
+                    state["gap"] = 0.7 * state["gap"] + 0.3 * (newest - state["last_story_at"])
+                state["last_story_at"] = newest
+        interval = self._next_interval(state, result, now)
+        with self._lock:
+            if self.accounts.get(uname) is state:
+                self._schedule(uname, now + interval * random.uniform(0.9, 1.1))
+        return True
+
+    def _save(self):
+        tmp_path = self.state_path.with_name(self.state_path.name + ".tmp")
+        try:
+            tmp_path.write_text(json.dumps(self.accounts), encoding="utf-8")
+            os.replace(tmp_path, self.state_path)
+        except Exception as e:
+            print(f"Warning: failed to save story watch schedule: {e}")
+
+    def run_due(self, api_client):
+        """Check the due accounts the budget allows right now, most overdue first; returns how many."""
+        self.reload()
+        checked = 0
+        while not shutdown_event.is_set():
+            now = time.time()
+            with self._lock:
+                while self._heap:
+                    when, uname = self._heap[0]
+                    state = self.accounts.get(uname)
+                    if state is not None and state["next_check_at"] == when:
+                        break
+                    heapq.heappop(self._heap)  # removed account or superseded entry
+                if not self._heap or self._heap[0][0] > now or self.budget.wait_needed(now) > 0:
+                    break
+                _, uname = heapq.heappop(self._heap)
+                self.budget.consume(now)
+            if self._check(api_client, uname):
+                checked += 1
+        if checked:
+            self._save()
+        return checked
+
+    def status(self):
+        now = time.time()
+        with self._lock:
+            due = sorted(self.accounts.items(), key=lambda item: item[1]["next_check_at"])
+        return [
+            (uname, max(0.0, state["next_check_at"] - now), state["gap"], state["archived"], state["checks"])
+            for uname, state in due
+        ]
 
 def download_latest_reel_of_username(api_client, username):
     try:
         uname = username.lstrip("@")
         user_id = get_user_id_from_username(api_client, uname)
-        try:
-            medias = api_client.user_clips(user_id, amount=10)
-        except Exception:
-            medias = api_client.user_medias(user_id, amount=15)
-            medias = [m for m in medias if getattr(m, "product_type", "").lower() == "clips"]
-        if not medias:
+        latest = latest_media.latest(api_client, user_id, "reels")
+        if latest is None:
             print(f"No reels found for {uname}")
             return
-        latest = sorted(medias, key=lambda m: getattr(m, "taken_at", None) or 0, reverse=True)[0]
         out_dir = get_user_download_path("reels", uname)
         out_dir.mkdir(parents=True, exist_ok=True)
-        api_client.clip_download(latest.id, filename=str(out_dir))
-        print(f"Downloaded latest reel of {uname} into {out_dir}")
+        summary = download_many([(f"latest reel of {uname}", lambda: download_media(api_client, latest, out_dir, uname, "reels"))])
+        if summary["ok"]:
+            print(f"Downloaded latest reel of {uname} into {out_dir}")
     except Exception as e:
         print(f"Download latest reel failed for {username}: {e}")
 
@@ -624,27 +2764,42 @@ def download_latest_post_of_username(api_client, username):
     try:
         uname = username.lstrip("@")
         user_id = get_user_id_from_username(api_client, uname)
-        medias = api_client.user_medias(user_id, amount=15)
-        medias = [m for m in medias if getattr(m, "product_type", "").lower() not in ("clips", "igtv")]
-        if not medias:
+        latest = latest_media.latest(api_client, user_id, "posts")
+        if latest is None:
             print(f"No posts found for {uname}")
             return
-        latest = sorted(medias, key=lambda m: getattr(m, "taken_at", None) or 0, reverse=True)[0]
         out_dir = get_user_download_path("posts", uname)
         out_dir.mkdir(parents=True, exist_ok=True)
-        # Choose download based on media type
-        try:
-            api_client.photo_download(latest.id, filename=str(out_dir))
-        except Exception:
-            api_client.media_download(latest.id, filename=str(out_dir))
-        print(f"Downloaded latest post of {uname} into {out_dir}")
+
+        # user_medias already told us the type (and carries the URLs), so no guessing
+        summary = download_many([(f"latest post of {uname}", lambda: download_media(api_client, latest, out_dir, uname, "posts"))])
+        if summary["ok"]:
+            kind, _, _, avoided = summary["ok"][0][1]
+            skipped = f"; skipped {avoided} API calls" if avoided else ""
+            print(f"Downloaded latest post of {uname} ({kind}) into {out_dir}{skipped}")
     except Exception as e:
         print(f"Download latest post failed for {username}: {e}")
 
+def show_downloads_of_username(api_client, username, limit=10):
+    uname = username.lstrip("@")
+    rows = blob_store().downloads_of(uname)
+    if not rows:
+        print(f"Nothing downloaded from {uname} yet")
+        return
+    by_type = {}
+    for _, _, media_type, size, _ in rows:
+        count, total = by_type.get(media_type or "other", (0, 0))
+        by_type[media_type or "other"] = (count + 1, total + size)
+    summary = ", ".join(f"{media_type} {count} ({total / 1e6:.1f} MB)" for media_type, (count, total) in sorted(by_type.items()))
+    print(f"Downloads of {uname}: {len(rows)} files; {summary}")
+    for path, pk, media_type, size, fetched_at in rows[:limit]:
+        fetched = time.strftime("%Y-%m-%d %H:%M", time.localtime(fetched_at))
+        print(f"  [{fetched}] {media_type or '?'} {pk or '-'} {size / 1e3:.0f} KB {path}")
+
 def print_user_status(api_client, username):
     try:
         uname = username.lstrip("@")
-        user_id = api_client.user_id_from_username(uname)
+        user_id = get_user_id_from_username(api_client, uname)
         try:
             activity = api_client.user_last_activity(user_id)
         except Exception:
@@ -667,12 +2822,48 @@ def print_user_status(api_client, username):
     except Exception as e:
         print(f"Status check failed for {username}: {e}")
 
+def poll_inbox(api_client):
+    """Process new DMs once; returns how many commands were executed."""
+    inbox = inbox_sync.poll(api_client)  # only threads with new activity
+    if PRINT_DMS and RESOLVE_USERNAMES:
+        sender_directory.prime(api_client, inbox)
+    commands = 0
+    for thread in inbox:
+        # Oldest first so the watermark only ever moves forward
+        for message in sorted(thread.messages, key=_message_position):
+            if not watermarks.is_new(thread.id, message):
+                continue
+            text = getattr(message, "text", None)
+            if PRINT_DMS:
+                sender = safe_username(api_client, message.user_id)
+                timestamp = (
+                    message.timestamp.strftime("%Y-%m-%d %H:%M:%S")
+                    if getattr(message, "timestamp", None)
+                    else ""
+                )
+                print(f"[{timestamp}] {sender}: {text}")
+            # Advance before executing so a crash mid-command never replays it
+            watermarks.advance(thread.id, message)
+            try:
+                if try_parse_and_execute_commands(api_client, text):
+                    commands += 1
+            except Exception as e:
+                # One broken command must not take the inbox (and the bot) down with it
+                print(f"Command failed for '{text}': {type(e).__name__}: {e}")
+                commands += 1
+        inbox_sync.commit(thread)
+    if inbox:
+        watermarks.save()
+    return commands
+
 def show_recent_dms(api_client, threads_amount=5):
     try:
         inbox = api_client.direct_threads(amount=threads_amount)
     except (ClientConnectionError, requests.exceptions.RequestException) as e:
         print(f"Show DM error: {e}")
         return
+    if RESOLVE_USERNAMES:
+        sender_directory.prime(api_client, inbox)
     for thread in inbox:
         try:
             for message in getattr(thread, "messages", []) or []:
@@ -702,104 +2893,427 @@ def download_profile_picture(api_client, username):
         out_dir.mkdir(parents=True, exist_ok=True)
         
         # Download the profile picture
-        response = requests.get(str(profile_pic_url))
-        if response.status_code == 200:
-            # Determine file extension from URL or default to .jpg
-            if str(profile_pic_url).endswith('.jpg') or str(profile_pic_url).endswith('.jpeg'):
-                ext = '.jpg'
-            elif str(profile_pic_url).endswith('.png'):
-                ext = '.png'
-            else:
-                ext = '.jpg'  # default
-            
-            filename = str(out_dir / f"{uname}_profile{ext}")
-            with open(filename, "wb") as f:
-                f.write(response.content)
-            print(f"✓ Profile picture downloaded to: {filename}")
-            return True
-        else:
-            print(f"✗ Failed to download profile picture for {uname} (HTTP {response.status_code})")
+        filename = out_dir / f"{uname}_profile{_url_extension(profile_pic_url)}"
+        try:
+            # Profile pictures change under the same user, so they are only deduplicated by content
+            blob_store().download(None, out_dir, lambda: fetch_media(profile_pic_url, filename), owner=uname, media_type="profile_pictures")
+        except requests.exceptions.HTTPError as e:
+            print(f"✗ Failed to download profile picture for {uname} (HTTP {e.response.status_code})")
             return False
+        print(f"✓ Profile picture downloaded to: {filename}")
+        return True
     except Exception as e:
         print(f"✗ Profile picture download failed for {username}: {e}")
         return False
 
+def _cmd_follow(api_client, username):
+    try:
+        user_id = get_user_id_from_username(api_client, username)
+        with rate_governor.action("follow"):
+            api_client.user_follow(user_id)
+        print(f"Followed: {username}")
+    except Exception as e:
+        print(f"Follow failed for {username}: {e}")
+
+def _cmd_unfollow(api_client, username):
+    try:
+        user_id = get_user_id_from_username(api_client, username)
+        with rate_governor.action("unfollow"):
+            api_client.user_unfollow(user_id)
+        print(f"Unfollowed: {username}")
+    except Exception as e:
+        print(f"Unfollow failed for {username}: {e}")
+
+def _cmd_send_dm(api_client, message_text, username):
+    send_dm_to_username(api_client, username, message_text.strip())
+
+def _cmd_show_dms(api_client, count="5"):
+    show_recent_dms(api_client, max(1, min(int(count), 20)))
+
+def _cmd_live_dms(api_client, mode):
+    global PRINT_DMS
+    PRINT_DMS = mode.lower() == "show"
+    print(f"Live DM printing {'enabled' if PRINT_DMS else 'disabled'}.")
+
+def _cmd_resolve_usernames(api_client, mode):
+    global RESOLVE_USERNAMES
+    RESOLVE_USERNAMES = mode.lower() == "on"
+    print(f"Username resolution {'enabled' if RESOLVE_USERNAMES else 'disabled'}.")
+
+def _cmd_scheduler_status(api_client):
+    state = scheduler.status()
+    print(
+        f"Inbox poll interval {state['interval']}s, next in {state['next_inbox_in']}s "
+        f"({state['polls']} polls, {state['idle_polls']} idle, error streak {state['error_streak']})"
+    )
+    if state["last_error"]:
+        print(f"  Last error: {state['last_error']}")
+    for name, task in state["tasks"].items():
+        print(f"  {name}: every {task['period']}s, next in {task['next_in']}s, {task['runs']} runs")
+
+def _cmd_http_stats(api_client):
+    stats = http_pool_stats()
+    if not stats:
+        print("No direct HTTP requests made yet.")
+    for host, counters in stats.items():
+        print(
+            f"{host}: {counters['requests']} requests over {counters['connections']} connections "
+            f"({counters['reused']} reused)"
+        )
+
+def _cmd_stats(api_client):
+    planner = download_planner_stats
+    print(
+        f"Download planner: {planner['planned']} planned from metadata, {planner['guessed']} guessed, "
+        f"{planner['avoided_calls']} API calls avoided"
+    )
+    index = latest_media.stats
+    print(
+        f"Latest-media index: {index['lookups']} lookups served by {index['feed_requests']} feed "
+        f"and {index['clips_requests']} reels requests"
+    )
+
+# Hashtag and location targeting
+def _cmd_like_hashtag(api_client, hashtag, amount="10"):
+    like_posts_from_hashtag(api_client, hashtag, int(amount))
+
+def _cmd_follow_hashtag(api_client, hashtag, amount="10"):
+    follow_from_hashtag(api_client, hashtag, int(amount))
+
+def _cmd_like_location(api_client, location, amount="10"):
+    like_posts_from_location(api_client, location, int(amount))
+
+def _cmd_watch(api_client, mode, username):
+    story_watch.set_watched(username, mode.lower() == "watch")
+    print(f"{'Watching' if mode.lower() == 'watch' else 'Stopped watching'} stories of @{username} ({len(story_watch.accounts)} accounts watched)")
+
+def _cmd_watchlist(api_client):
+    story_watch.reload()
+    rows = story_watch.status()
+    if not rows:
+        print(f"Watch list is empty. Add accounts with `watch @user` or one per line in {STORY_WATCH_FILE}.")
+        return
+    print(f"{len(rows)} accounts watched, up to {story_watch.budget.per_hour} checks/hour:")
+    for uname, next_in, gap, archived, checks in rows[:20]:
+        print(f"  @{uname}: next check in {int(next_in // 60)} min, posts every ~{gap / 3600:.1f} h, {archived} stories archived in {checks} checks")
+
+def _cmd_limits(api_client):
+    report, cooldown_left, reason = rate_governor.remaining()
+    if cooldown_left:
+        print(f"Cooling down for {int(cooldown_left // 60)} more min after: {reason}")
+    for action, budget in report.items():
+        next_in = f", next in {int(budget['next_in'])}s" if budget["next_in"] else ""
+        print(f"  {action}: {budget['hour_left']} left this hour, {budget['day_left']} today{next_in}")
+
+USER = r"@(?P<username>[A-Za-z0-9._]+)"
+AMOUNT = r"(?:\s+(?P<amount>\d+))?"
+
+# (first-word keywords, full-match grammar, handler, help text)
+COMMAND_TABLE = [
+    (("follow",), rf"follow\s+{USER}", _cmd_follow, "follow @<username>"),
+    (("unfollow",), rf"unfollow\s+{USER}", _cmd_unfollow, "unfollow @<username>"),
+    (("like",), rf"like\s+(?:the\s+)?latest\s+reel\s+of\s+{USER}", like_latest_reel, "like the latest reel of @<username>"),
+    (("like",), rf"like\s+(?:the\s+)?latest\s+post\s+of\s+{USER}", like_latest_post, "like the latest post of @<username>"),
+    (("write", "send"), rf"(?:write|send)\s+(?P<message_text>.+?)\s+to\s+{USER}", _cmd_send_dm, "write <message> to @<username>"),
+    (("download",), rf"download\s+(?:story|stories)\s+of\s+{USER}", download_stories_of_username, "download stories of @<username>"),
+    (("download",), rf"download\s+(?:latest\s+)?reel\s+of\s+{USER}", download_latest_reel_of_username, "download latest reel of @<username>"),
+    (("download",), rf"download\s+(?:latest\s+)?post\s+of\s+{USER}", download_latest_post_of_username, "download latest post of @<username>"),
+    (("download",), rf"download\s+profile\s+picture\s+of\s+{USER}", download_profile_picture, "download profile picture of @<username>"),
+    (("downloads",), rf"downloads\s+of\s+{USER}", show_downloads_of_username, "downloads of @<username>"),
+    (("status",), rf"status\s+of\s+{USER}", print_user_status, "status of @<username>"),
+    (("watch", "unwatch"), rf"(?P<mode>watch|unwatch)\s+{USER}", _cmd_watch, "watch @<username> | unwatch @<username>"),
+    (("watchlist",), r"watchlist", _cmd_watchlist, "watchlist"),
+    (("show",), r"show\s+dms?(?:\s+(?P<count>\d+))?", _cmd_show_dms, "show dm | show dms <n>"),
+    (("show", "hide"), r"(?P<mode>show|hide)\s+live\s+dms", _cmd_live_dms, "show live dms | hide live dms"),
+    (("resolve",), r"resolve\s+usernames\s+(?P<mode>on|off)", _cmd_resolve_usernames, "resolve usernames on|off"),
+    (("like",), rf"like\s+posts\s+from\s+hashtag\s+#?(?P<hashtag>\w+){AMOUNT}", _cmd_like_hashtag, "like posts from hashtag <tag> [n]"),
+    (("follow",), rf"follow\s+from\s+hashtag\s+#?(?P<hashtag>\w+){AMOUNT}", _cmd_follow_hashtag, "follow from hashtag <tag> [n]"),
+    (("like",), rf"like\s+posts\s+from\s+location\s+(?P<location>\w+){AMOUNT}", _cmd_like_location, "like posts from location <location> [n]"),
+    (("scheduler",), r"scheduler(?:\s+status)?", _cmd_scheduler_status, "scheduler"),
+    (("http",), r"http\s+stats", _cmd_http_stats, "http stats"),
+    (("stats",), r"stats", _cmd_stats, "stats"),
+    (("limits",), r"limits", _cmd_limits, "limits"),
+]
+
+command_registry = CommandRegistry(COMMAND_TABLE)
+
+def cmd_help(args):
+    print_usage()
+    return 0
+
+def cmd_ip(args):
+    secrets = load_secrets()
+    ip = get_public_ip()
+    if not ip:
+        print("Could not determine public IP.")
+        return 1
+    allowed = ip in set(secrets.get("allowed_ips", []) or [])
+    print(f"{ip} ({'allowed' if allowed else 'not yet in allowed_ips'})")
+    return 0
+
+def cmd_dedupe(args):
+    folder = Path(args[0]) if args else Path("downloads")
+    files, saved = blob_store().rebuild(folder)
+    checked, dropped = blob_store().verify(batch=-1)
+    print(f"Indexed {files} files under {folder}, {saved / 1e6:.1f} MB freed by deduplication")
+    print(f"Verified {checked} blobs ({dropped} corrupt ones quarantined)")
+    return 0
+
+def cmd_download(args):
+    if not args:
+        print("Error: URL required for download command")
+        print_usage()
+        return 1
+    args = list(args)
+    results_path, workers, source = BULK_RESULTS_PATH, DOWNLOAD_WORKERS, None
+    for flag in ("--results", "--workers", "--file"):
+        if flag in args:
+            i = args.index(flag)
+            if i + 1 >= len(args):
+                print(f"Error: {flag} needs a value")
+                return 1
+            value = args[i + 1]
+            del args[i:i + 2]
+            if flag == "--results":
+                results_path = value
+            elif flag == "--workers":
+                if not value.isdigit() or int(value) < 1:
+                    print(f"Error: --workers needs a positive number, got '{value}'")
+                    return 1
+                workers = int(value)
+            else:
+                source = value
+    if "-" in args:
+        args.remove("-")
+        source = "-"
+    try:
+        urls = args + (_read_url_list(source) if source else [])
+    except OSError as e:
+        print(f"Error: cannot read URL list {source}: {e.strerror or e}")
+        return 1
+    if not urls:
+        print("Error: no URLs given")
+        return 1
+    start_session()
+    print(f"\n🔽 Download Mode\n{'='*60}")
+    if len(urls) == 1 and source is None:
+        return 0 if download_from_url(cl, urls[0]) else 1
+    _, failed = download_bulk(cl, urls, results_path, workers)
+    return 1 if failed else 0
+
+def run_bot(api_client, interactive=True, account_queues=True):
+    """Poll DMs and drain the queues until interrupted; `account_queues` adds the unfollow/post queues."""
+    blob_store().start_verifier()
+    # Queue drains run on their own cadences, independent of inbox polling
+    scheduler.add_task("follow_queue", process_follow_queue, 60)
+    scheduler.add_task("like_queue", process_like_queue, 60)
+    scheduler.add_task("comment_queue", process_comment_queue, 90)
+    scheduler.add_task("download_queue", process_download_queue, 60)
+    if account_queues:
+        scheduler.add_task("unfollow_queue", process_unfollow_queue, 60)
+        scheduler.add_task("post_queue", process_post_queue, 300)
+        # Every due check is paced by the watch list's own budget, so a short cadence is cheap
+        scheduler.add_task("story_watch", lambda api: story_watch.run_due(api), STORY_WATCH_TICK)
+    try:
+        asyncio.run(BotRuntime(api_client, scheduler).run(poll_inbox, interactive=interactive))
+    except KeyboardInterrupt:
+        pass
+    print("Bot stopped.")
+
+def cmd_bot(args):
+    start_session()
+    print("\n🤖 Bot Mode - Starting Instagram Bot")
+    print("="*60)
+    run_bot(cl)
+    return 0
+
+def farm_accounts(secrets):
+    """Accounts from credentials_by_ip (plus the top-level one), primary first, deduplicated."""
+    entries = []
+    if secrets.get("username") and secrets.get("password"):
+        entries.append({"username": secrets["username"], "password": secrets["password"]})
+    entries.extend((secrets.get("credentials_by_ip", {}) or {}).values())
+    accounts = {}
+    for entry in entries:
+        uname = (entry or {}).get("username")
+        if uname and entry.get("password") and uname not in accounts:
+            accounts[uname] = {"username": uname, "password": entry["password"], "weight": float(entry.get("weight", 1))}
+    return list(accounts.values())
+
+def cmd_worker(args):
+    global QUEUE_SHARD
+    if not args:
+        print("Error: account username required for worker command")
+        return 1
+    account = next((a for a in farm_accounts(load_secrets()) if a["username"] == args[0]), None)
+    if account is None:
+        print(f"Error: no credentials for '{args[0]}' in secrets.json")
+        return 1
+    QUEUE_SHARD = account["username"]
+    start_session((account["username"], account["password"]))
+    run_bot(cl, interactive=False, account_queues="--primary" in args)
+    return 0
+
+class WorkerFarm:
+    """Supervisor for one `insta.py worker <account>` process per configured account.
+
+    It owns the shared queue files: new items are ingested once and spread over
+    the live workers' shards in proportion to each account's remaining hourly
+    budget (times an optional per-account `weight`). Crashed workers are
+    restarted with exponential backoff and their unfinished shard goes back to
+    the shared pool in the meantime.
+    """
+
+    def __init__(self, accounts, report_every=60):
+        self.accounts = accounts
+        self.primary = accounts[0]["username"]
+        self.report_every = report_every
+        self.workers = {a["username"]: {"proc": None, "restarts": 0, "start_at": 0.0} for a in accounts}
+        self.queues = {name: job_queue(name) for name in SHARDED_QUEUES}
+
+    def _spawn(self, uname):
+        cmd = [sys.executable, "-u", os.path.abspath(__file__), "worker", uname]
+        if uname == self.primary:
+            cmd.append("--primary")
+        proc = subprocess.Popen(cmd, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True)
+        threading.Thread(target=self._pump, args=(uname, proc), daemon=True).start()
+        self.workers[uname]["proc"] = proc
+        print(f"[farm] started worker {uname} (pid {proc.pid})")
+
+    @staticmethod
+    def _pump(uname, proc):
+        for line in proc.stdout:
+            print(f"[{uname}] {line.rstrip()}")
+
+    def _supervise(self):
+        now = time.time()
+        for uname, worker in self.workers.items():
+            proc = worker["proc"]
+            if proc is not None and proc.poll() is None:
+                continue
+            if proc is not None:
+                worker["restarts"] += 1
+                delay = min(300, 5 * 2 ** min(worker["restarts"], 6))
+                worker["start_at"] = now + delay
+                worker["proc"] = None
+                print(f"[farm] worker {uname} exited with {proc.returncode}; restarting in {delay}s")
+                for name, queue in self.queues.items():
+                    queue.reclaim(f"{name}@{uname}")
+            if now >= worker["start_at"]:
+                self._spawn(uname)
+
+    def _history(self, uname):
+        try:
+            data = json.loads(Path(f"ratelimits_{uname}.json").read_text(encoding="utf-8"))
+            return data.get("history", {})
+        except Exception:
+            return {}
+
+    def _shares(self, name):
+        action = name if name in RATE_LIMITS else None
+        live = [a for a in self.accounts if self.workers[a["username"]]["proc"] is not None]
+        shares = {}
+        for account in live:
+            capacity = 1.0
+            if action:
+                cutoff = time.time() - 3600
+                used = sum(1 for ts in self._history(account["username"]).get(action, []) if ts > cutoff)
+                capacity = max(0, RATE_LIMITS[action][0] - used)
+            shares[f"{name}@{account['username']}"] = capacity * account["weight"]
+        if shares and not any(shares.values()):
+            # Everyone is out of budget: still spread the work, workers will pace it
+            shares = dict.fromkeys(shares, 1.0)
+        return shares
+
+    def _distribute(self):
+        for name, queue in self.queues.items():
+            try:
+                queue.ingest()
+                queue.distribute(self._shares(name))
+            except Exception as e:
+                print(f"[farm] failed to distribute {name} queue: {e}")
+
+    def _report(self, started):
+        cutoff = time.time() - 3600
+        per_account = {
+            a["username"]: sum(1 for stamps in self._history(a["username"]).values() for ts in stamps if ts > cutoff)
+            for a in self.accounts
+        }
+        alive = sum(1 for w in self.workers.values() if w["proc"] is not None)
+        backlog = ", ".join(f"{name} {queue.pending()}" for name, queue in self.queues.items())
+        breakdown = ", ".join(f"{u} {n}" for u, n in per_account.items())
+        print(
+            f"[farm] {alive}/{len(self.workers)} workers up {int((time.time() - started) // 60)} min, "
+            f"{sum(per_account.values())} actions in the last hour ({breakdown}); unassigned: {backlog}"
+        )
+
+    def run(self):
+        started = last_report = time.time()
+        try:
+            while True:
+                self._supervise()
+                self._distribute()
+                if time.time() - last_report >= self.report_every:
+                    self._report(started)
+                    last_report = time.time()
+                time.sleep(5)
+        except KeyboardInterrupt:
+            print("\n[farm] stopping workers")
+        finally:
+            for worker in self.workers.values():
+                if worker["proc"] is not None and worker["proc"].poll() is None:
+                    worker["proc"].terminate()
+
+def cmd_farm(args):
+    accounts = farm_accounts(load_secrets())
+    if not accounts:
+        print("No accounts configured. Add username/password pairs to credentials_by_ip in secrets.json.")
+        return 1
+    print(f"\n🧑‍🌾 Farm Mode - {len(accounts)} accounts: {', '.join(a['username'] for a in accounts)}")
+    print("="*60)
+    WorkerFarm(accounts).run()
+    return 0
+
+# (aliases, usage, description, handler); only the handlers that need it log in
+SUBCOMMANDS = [
+    (("bot",), "bot", "Start bot (monitors DMs and queues)", cmd_bot),
+    (("d", "download"), "d <url>...", "Download stories/reels/posts; `--file <path>` or `-` (stdin) for bulk", cmd_download),
+    (("farm",), "farm", "Run one worker per account in secrets.json and share the queues", cmd_farm),
+    (("worker",), "worker <account>", "Run a single farm worker (started by `farm`)", cmd_worker),
+    (("dedupe",), "dedupe [folder]", "Rebuild the download manifest, deduplicate and verify downloads (no login)", cmd_dedupe),
+    (("ip",), "ip", "Show the detected public IP and whether it is allowed (no login)", cmd_ip),
+    (("h", "help", "--help", "-h"), "help", "Show this help (no login, no network)", cmd_help),
+]
+
 def print_usage():
     """Print usage instructions"""
     print("\n" + "="*60)
     print("Instagram Bot - Usage")
     print("="*60)
-    print("\nCLI Download Mode:")
-    print("  python insta.py d <url>         - Download from URL")
-    print("  python insta.py download <url>  - Download from URL")
+    print("\nCommands:")
+    for _, usage, description, _ in SUBCOMMANDS:
+        print(f"  python insta.py {usage:<16} - {description}")
     print("\nExamples:")
     print("  python insta.py d https://www.instagram.com/reel/xxxxx/")
     print("  python insta.py d https://www.instagram.com/stories/username/xxxxx/")
     print("  python insta.py d https://www.instagram.com/p/xxxxx/")
+    print("  python insta.py d --file links.txt --workers 4 --results archive.jsonl")
+    print("  cat links.txt | python insta.py d -")
     print("\nBot Mode (default):")
     print("  python insta.py                 - Start bot (monitors DMs and queues)")
     print("="*60 + "\n")
 
-# Check for command line arguments
-if len(sys.argv) > 1:
-    command = sys.argv[1].lower()
-    
-    if command in ("d", "download"):
-        if len(sys.argv) < 3:
-            print("Error: URL required for download command")
-            print_usage()
-            sys.exit(1)
-        
-        url = sys.argv[2]
-        print(f"\n🔽 Download Mode\n{'='*60}")
-        success = download_from_url(cl, url)
-        sys.exit(0 if success else 1)
-    
-    elif command in ("h", "help", "--help", "-h"):
-        print_usage()
-        sys.exit(0)
-    
-    else:
-        print(f"Error: Unknown command '{command}'")
-        print_usage()
-        sys.exit(1)
-
-# Normal bot mode (no CLI arguments)
-print("\n🤖 Bot Mode - Starting Instagram Bot")
-print("="*60)
-
-start_command_session(cl)
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+    if not argv:
+        return cmd_bot([])
+    command = argv[0].lower()
+    for aliases, _, _, handler in SUBCOMMANDS:
+        if command in aliases:
+            return handler(argv[1:])
+    print(f"Error: Unknown command '{command}'")
+    print_usage()
+    return 1
 
-while True:
-    try:
-        inbox = cl.direct_threads(amount=5)  # fetch recent 5 threads
-    except (ClientConnectionError, requests.exceptions.RequestException) as e:
-        print(f"Inbox fetch error: {e}")
-        time.sleep(30)
-        continue
-    
-    for thread in inbox:
-        for message in thread.messages:
-            if message.id not in seen_messages:
-                sender = safe_username(cl, message.user_id)
-                timestamp = (
-                    message.timestamp.strftime("%Y-%m-%d %H:%M:%S")
-                    if getattr(message, "timestamp", None)
-                    else ""
-                )
-                text = getattr(message, "text", None)
-                if PRINT_DMS:
-                    print(f"[{timestamp}] {sender}: {text}")
-                try_parse_and_execute_commands(cl, text)
-                
-                # mark as seen
-                seen_messages.add(message.id)
-    
-    # Process follow / unfollow queues each cycle
-    process_follow_queue(cl)
-    process_unfollow_queue(cl)
-    process_like_queue(cl)
-    process_comment_queue(cl)
-    process_post_queue(cl)
-    
-    time.sleep(30)  # check every 30 sec
+if __name__ == "__main__":
+    sys.exit(main())